@@ -0,0 +1,117 @@
+# answer_cache.py
+# Per-document cache of answers, matched by exact (normalized) question text
+# or by question-embedding cosine similarity.
+import os, re, time, threading
+from collections import OrderedDict
+
+import numpy as np
+
+from references import question_refs
+
+
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL_S = int(os.getenv("ANSWER_CACHE_TTL_S", str(24 * 3600)))
+ANSWER_CACHE_MAX_PER_DOC = int(os.getenv("ANSWER_CACHE_MAX_PER_DOC", "200"))
+
+# doc_id -> normalized question -> { "question", "embedding", "refs", "answer", "created_at" },
+# least recently used first.
+_cache: dict[str, "OrderedDict[str, dict]"] = {}
+_lock = threading.Lock()
+_stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+
+
+def normalize_question(question: str) -> str:
+    q = re.sub(r"\s+", " ", question.strip().lower())
+    return q.rstrip(" ?.!")
+
+
+def question_keys(question: str) -> tuple:
+    """Figure/table refs and other numbers in a question.
+
+    MiniLM embeddings barely separate "Explain Figure 3" from "Explain
+    Figure 4", so a semantic hit is only allowed between questions with the
+    same keys.
+    """
+    numbers = sorted(set(re.findall(r"\d+(?:\.\d+)?", question)))
+    return tuple(sorted(question_refs(question))), tuple(numbers)
+
+
+def _unit(vec) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def _drop_expired(entries: "OrderedDict[str, dict]") -> None:
+    cutoff = time.time() - ANSWER_CACHE_TTL_S
+    for key in [k for k, e in entries.items() if e["created_at"] < cutoff]:
+        del entries[key]
+
+
+def lookup(doc_id: str, question: str, q_emb=None) -> str | None:
+    """Return a cached answer for this question about doc_id, or None."""
+    key = normalize_question(question)
+
+    with _lock:
+        entries = _cache.get(doc_id)
+        if entries:
+            _drop_expired(entries)
+
+        if entries and key in entries:
+            entries.move_to_end(key)
+            _stats["exact_hits"] += 1
+            return entries[key]["answer"]
+
+        refs = question_keys(question)
+        keys = [
+            k for k, e in (entries or {}).items()
+            if e["embedding"] is not None and e["refs"] == refs
+        ]
+        if keys and q_emb is not None:
+            matrix = np.stack([entries[k]["embedding"] for k in keys])
+            sims = matrix @ _unit(q_emb)
+            best = int(np.argmax(sims))
+            if sims[best] >= ANSWER_CACHE_SIMILARITY:
+                entries.move_to_end(keys[best])
+                _stats["semantic_hits"] += 1
+                return entries[keys[best]]["answer"]
+
+        _stats["misses"] += 1
+        return None
+
+
+def store(doc_id: str, question: str, answer: str, q_emb=None) -> None:
+    # Without an embedding the entry can still serve exact repeats.
+    key = normalize_question(question)
+    embedding = _unit(q_emb) if q_emb is not None else None
+
+    with _lock:
+        entries = _cache.setdefault(doc_id, OrderedDict())
+        entries.pop(key, None)
+        entries[key] = {
+            "question": question,
+            "embedding": embedding,
+            "refs": question_keys(question),
+            "answer": answer,
+            "created_at": time.time(),
+        }
+        while len(entries) > ANSWER_CACHE_MAX_PER_DOC:
+            entries.popitem(last=False)
+
+
+def invalidate(doc_id: str) -> int:
+    """Drop every cached answer about doc_id (its index was rebuilt); returns how many."""
+    with _lock:
+        return len(_cache.pop(doc_id, None) or {})
+
+
+def stats() -> dict:
+    with _lock:
+        hits = _stats["exact_hits"] + _stats["semantic_hits"]
+        total = hits + _stats["misses"]
+        return {
+            **_stats,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            "documents": len(_cache),
+            "entries": sum(len(e) for e in _cache.values()),
+        }
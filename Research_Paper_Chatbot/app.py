@@ -1,12 +1,52 @@
 # app.py
-from fastapi import FastAPI, UploadFile, File
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-import os, shutil
+import os, json, threading
 
-from pipeline import build_index, ask_llm
+from pipeline import ask_llm, ask_llm_stream, has_document, warm_up, is_ready
+from jobs import submit_index_job, get_job, find_active_job
+from upload_store import MAX_UPLOAD_MB, UploadTooLarge, save_upload, save_pdf_bytes, maybe_gc_uploads
+import answer_cache
+import corpus_index
+import metrics
+import paper_store
+import sessions
 
-app = FastAPI(title="Research Paper Chatbot Backend")
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "1") == "1"
+
+
+def _warm_up_in_background() -> None:
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"[WARM_UP] failed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start serving right away; /readyz reports 503 until the embedder is loaded.
+    if WARM_UP_ON_STARTUP:
+        threading.Thread(target=_warm_up_in_background, name="warm-up", daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Research Paper Chatbot Backend", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def reject_large_uploads(request: Request, call_next):
+    # Refuse before the multipart body is read when the client declares its size;
+    # save_upload enforces the same limit for chunked bodies. Registered before
+    # CORSMiddleware so the 413 still carries the CORS headers.
+    if request.url.path == "/upload":
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > MAX_UPLOAD_MB * 1024 * 1024 + 64 * 1024:
+            return JSONResponse(status_code=413, content={"detail": f"PDF is larger than {MAX_UPLOAD_MB} MB."})
+    return await call_next(request)
 
 
 app.add_middleware(
@@ -17,31 +57,157 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    if not is_ready():
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready"}
 
 
 @app.post("/upload")
 async def upload_pdf(file: UploadFile = File(...)):
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
+    # The file is copied and hashed in one chunked pass, stored as
+    # uploads/<sha256>.pdf; indexing runs as a background job polled
+    # through /jobs/{job_id}.
+    try:
+        file_path, doc_id, size = await save_upload(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    num_docs = build_index(file_path)
+    # Identical PDFs share one doc_id, so re-uploads reuse the cached index.
+    job = await run_in_threadpool(submit_index_job, file_path, doc_id=doc_id, content_hash=doc_id)
+    await run_in_threadpool(maybe_gc_uploads, lambda h: find_active_job(h) is not None)
 
     return {
-        "status": "uploaded_and_indexed",
+        "status": "queued",
+        "job_id": job["job_id"],
+        "doc_id": doc_id,
         "file_path": file_path,
-        "docs_in_index": num_docs,
+        "size_bytes": size,
     }
 
 
+@app.post("/papers/{paper_id}/open")
+def open_paper(paper_id: str):
+    """Open a stored catalog paper for chat by its papers.id instead of uploading it.
+
+    Papers handled by prebuild_indexes.py are ready at once; any other stored
+    paper is fetched from the bucket and indexed as a background job.
+    """
+    if not paper_store.is_paper_id(paper_id):
+        raise HTTPException(status_code=404, detail="Unknown paper_id.")
+
+    doc_id = paper_store.paper_hash(paper_id)
+    if doc_id and has_document(doc_id):
+        return {"status": "ready", "doc_id": doc_id}
+    job = find_active_job(doc_id) if doc_id else None
+    if job is not None:
+        return {"status": "queued", "job_id": job["job_id"], "doc_id": doc_id}
+
+    # Not prebuilt yet (stored after the last prebuild run): fetch it now.
+    try:
+        supa = paper_store.get_supabase()
+        paper = paper_store.fetch_paper(supa, paper_id)
+        if paper is None or not paper.get("stored_pdf_path"):
+            raise HTTPException(status_code=404, detail="This paper has no stored PDF.")
+        pdf_bytes = paper_store.download_pdf(supa, paper["stored_pdf_path"])
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[OPEN_PAPER] {paper_id}: {e}")
+        raise HTTPException(status_code=502, detail="Could not fetch the paper from storage.")
+
+    file_path, doc_id = save_pdf_bytes(pdf_bytes)
+    paper_store.save_paper_hash(paper_id, doc_id, paper["stored_pdf_path"])
+    if has_document(doc_id):
+        return {"status": "ready", "doc_id": doc_id}
+
+    job = submit_index_job(file_path, doc_id=doc_id, content_hash=doc_id)
+    return {"status": "queued", "job_id": job["job_id"], "doc_id": doc_id}
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"answers": answer_cache.stats()}
+
+
+@app.get("/corpus/search")
+def corpus_search(q: str, k: int = 10, main_field: str | None = None, sub_field: str | None = None):
+    """Semantic search over every paper added by corpus_index.py, best paper first."""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty query.")
+    k = max(1, min(k, 50))
+    results = corpus_index.search_corpus(q, k=k, main_field=main_field, sub_field=sub_field)
+    return {"query": q, "results": results, "papers_indexed": corpus_index.corpus_stats()["papers"]}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job_id.")
+    return job
+
+
 class AskRequest(BaseModel):
     question: str
+    # From /upload or /papers/{paper_id}/open; required so answers never
+    # come from another user's paper.
+    doc_id: str
+    # Omit to start a new conversation; send back the returned id for follow-ups.
+    session_id: str | None = None
+
 
+def _check_doc_ready(doc_id: str) -> None:
+    if not doc_id:
+        raise HTTPException(status_code=400, detail="doc_id is required; upload or open a paper first.")
+    if not has_document(doc_id):
+        if find_active_job(doc_id):
+            raise HTTPException(status_code=409, detail="This paper is still being indexed, please wait.")
+        raise HTTPException(status_code=404, detail="Unknown doc_id, please upload the PDF again.")
 
+
+# Plain def: FastAPI runs it in a worker thread, so the blocking LLM call
+# does not stall the event loop.
 @app.post("/ask")
-async def ask_question(body: AskRequest):
-    answer = ask_llm(body.question)
-    return {"answer": answer}
+def ask_question(body: AskRequest):
+    _check_doc_ready(body.doc_id)
+    session = sessions.get_or_create(body.session_id, body.doc_id)
+
+    answer = ask_llm(body.question, doc_id=body.doc_id, session=session)
+    return {"answer": answer, "doc_id": body.doc_id, "session_id": session["session_id"]}
+
+
+@app.post("/ask/stream")
+def ask_question_stream(body: AskRequest):
+    """Server-sent events: one `data: {"delta": ...}` per token chunk, then `event: done` with the session_id."""
+    _check_doc_ready(body.doc_id)
+    session = sessions.get_or_create(body.session_id, body.doc_id)
+
+    # Sync generator: Starlette iterates it in a worker thread.
+    def events():
+        try:
+            for delta in ask_llm_stream(body.question, doc_id=body.doc_id, session=session):
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+        except Exception as e:
+            print(f"[ASK_STREAM] ERROR: {e}")
+            yield f"event: error\ndata: {json.dumps({'error': 'Error while generating the answer.'})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'session_id': session['session_id']})}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,257 @@
+# bench_pipeline.py
+# Reproducible benchmark for the chatbot indexing and answering path.
+#
+#   cd Research_Paper_Chatbot
+#   python benchmarks/bench_pipeline.py --pages 5 20 --figures 0 2 --json bench.json
+#
+# Synthetic PDFs are generated with PyMuPDF, the OpenAI client is replaced
+# by a local fake (no network, no tokens) and all caches point at a fresh
+# temporary directory, so every run measures cold indexing.
+import os, sys, json, time, zlib, random, argparse, platform, resource, statistics, tempfile
+from types import SimpleNamespace
+
+_TMP = tempfile.mkdtemp(prefix="chatbot_bench_")
+os.environ["INDEX_CACHE_DIR"] = os.path.join(_TMP, "index_cache")
+os.environ.setdefault("WARM_UP_ON_STARTUP", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+import numpy as np
+
+import llm_gateway
+import pipeline
+import vector_index
+from pipeline import extract_text_clean, chunk_text
+from pages import iter_page_images, detect_visual_blocks, process_pdf
+
+
+WORDS = (
+    "model training data results method evaluation baseline accuracy network "
+    "attention layer dataset benchmark performance learning figure table loss "
+    "gradient optimization transformer embedding retrieval inference latency"
+).split()
+
+QUESTIONS = [
+    "What problem does this paper solve?",
+    "Explain Figure 3.",
+    "What dataset is used for evaluation?",
+    "How does the proposed method compare to the baseline?",
+    "What are the limitations of the approach?",
+]
+
+
+class FakeCompletions:
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+
+    def create(self, model, messages, max_completion_tokens=None, stream=False, **kwargs):
+        time.sleep(self.latency_s)
+        text = "The figure shows accuracy increasing with model size across three benchmarks."
+        usage = SimpleNamespace(prompt_tokens=500, completion_tokens=20, prompt_tokens_details=None)
+        if stream:
+            delta = SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+            return iter([delta, SimpleNamespace(choices=[], usage=usage)])
+        message = SimpleNamespace(content=text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+class FakeOpenAI:
+    """Stand-in for openai.OpenAI with the subset of the API the pipeline uses."""
+
+    def __init__(self, latency_s: float = 0.0):
+        self.chat = SimpleNamespace(completions=FakeCompletions(latency_s))
+
+    def with_options(self, **kwargs):
+        return self
+
+
+class FakeEmbedder:
+    """Deterministic random-projection embedder for machines without the model."""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def encode(self, texts, convert_to_numpy=True, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            rng = np.random.default_rng(zlib.crc32(t.encode("utf-8")))
+            out[i] = rng.standard_normal(self.dim)
+        return out
+
+
+def make_pdf(path: str, pages: int, figures_per_page: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page(width=612, height=792)
+        text = " ".join(rng.choice(WORDS) for _ in range(450))
+        page.insert_textbox(fitz.Rect(50, 50, 562, 742), f"Section {p + 1}. {text}", fontsize=9)
+
+        for f in range(figures_per_page):
+            top = 120 + f * (600 / max(1, figures_per_page))
+            rect = fitz.Rect(80, top, 530, top + 180)
+            page.draw_rect(rect, color=(0, 0, 0), fill=(0.85, 0.88, 0.95), width=1.5)
+            for b in range(6):
+                h = rng.uniform(20, 150)
+                bar = fitz.Rect(110 + b * 65, rect.y1 - 10 - h, 150 + b * 65, rect.y1 - 10)
+                page.draw_rect(bar, color=None, fill=(0.2, 0.3, 0.6))
+            page.insert_text((rect.x0, rect.y1 + 14), f"Figure {p * figures_per_page + f + 1}: synthetic results.", fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS; it is a process-wide peak.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+
+def measure(fn, repeat: int) -> tuple[float, object]:
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def bench_document(pdf_path: str, pages: int, figures: int, repeat: int) -> list[dict]:
+    rows = []
+
+    def row(stage: str, seconds: float, items: int, unit: str) -> None:
+        rows.append({
+            "pages": pages,
+            "figures_per_page": figures,
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "items": items,
+            "unit": unit,
+            "items_per_s": round(items / seconds, 2) if seconds else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        })
+
+    secs, text = measure(lambda: extract_text_clean(pdf_path), repeat)
+    row("extract_text_clean", secs, pages, "pages")
+    chunks = chunk_text(text)
+
+    secs, _ = measure(lambda: sum(1 for _ in iter_page_images(pdf_path)), repeat)
+    row("iter_page_images", secs, pages, "pages")
+
+    for mode in ("full", "thumbnail"):
+        secs, _ = measure(lambda: process_pdf(pdf_path, with_text=True, workers=0, detect_mode=mode), repeat)
+        row(f"process_pdf ({mode})", secs, pages, "pages")
+
+    images = [np.array(p["image"]) for p in iter_page_images(pdf_path)]
+    secs, _ = measure(lambda: sum(len(detect_visual_blocks(img)[0]) for img in images), repeat)
+    row("detect_visual_blocks", secs, pages, "pages")
+    del images
+
+    model = pipeline.get_embed_model()
+    secs, _ = measure(lambda: model.encode(chunks, convert_to_numpy=True), repeat)
+    row("embedding", secs, len(chunks), "docs")
+
+    pipeline._registry.clear()
+    start = time.perf_counter()
+    num_docs = pipeline.build_index(pdf_path, doc_id=f"bench-{pages}-{figures}")
+    row("build_index (cold)", time.perf_counter() - start, num_docs, "docs")
+
+    doc_id = f"bench-{pages}-{figures}"
+    queries = QUESTIONS * 4
+    secs, _ = measure(lambda: [pipeline.get_context(q, doc_id=doc_id) for q in queries], repeat)
+    row("get_context", secs, len(queries), "queries")
+
+    return rows
+
+
+def clustered_vectors(n: int, dim: int = 384, clusters: int = 64, seed: int = 0) -> np.ndarray:
+    # Chunks of one paper are far from uniform; clustered data keeps ANN recall realistic.
+    # The cluster centers are fixed, so queries (another seed) fall into the
+    # same clusters as the indexed vectors. Rows are unit length like MiniLM's
+    # outputs, so L2 (flat) and cosine agree on the nearest neighbours.
+    centers = np.random.default_rng(12345).standard_normal((clusters, dim)).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, clusters, n)
+    vectors = centers[labels] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vector_index.normalize(vectors)
+
+
+def bench_backends(n_vectors: int, k: int = 5, n_queries: int = 200) -> list[dict]:
+    """Recall@k against exact cosine search, query latency, build time and size per INDEX_BACKEND."""
+    vectors = clustered_vectors(n_vectors)
+    queries = clustered_vectors(n_queries, seed=1)
+
+    exact, _ = vector_index.build_vector_index(vectors, "ip")
+    _, truth = vector_index.search(exact, queries, k)
+
+    rows = []
+    for backend in vector_index.BACKENDS:
+        start = time.perf_counter()
+        index, used = vector_index.build_vector_index(vectors, backend)
+        build_s = time.perf_counter() - start
+
+        latencies, found = [], 0
+        for q, expected in zip(queries, truth):
+            start = time.perf_counter()
+            _, ids = vector_index.search(index, q, k)
+            latencies.append(time.perf_counter() - start)
+            found += len(set(ids[0]) & set(expected))
+
+        rows.append({
+            "vectors": n_vectors,
+            "backend": backend if used == backend else f"{backend}->{used}",
+            f"recall@{k}": round(found / (k * n_queries), 4),
+            "query_ms_p50": round(statistics.median(latencies) * 1000, 4),
+            "query_ms_p95": round(sorted(latencies)[int(0.95 * len(latencies))] * 1000, 4),
+            "build_s": round(build_s, 3),
+            "index_mb": round(vector_index.index_nbytes(index) / 1e6, 2),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot indexing and retrieval path.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[5, 20])
+    parser.add_argument("--figures", type=int, nargs="+", default=[0, 2], help="figures per page")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; the median is reported")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds each fake LLM call sleeps")
+    parser.add_argument("--fake-embedder", action="store_true", help="skip loading SentenceTransformer")
+    parser.add_argument("--index-vectors", type=int, nargs="*", default=[2000, 50000],
+                        help="sizes for the INDEX_BACKEND recall-vs-latency report (none to skip)")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    llm_gateway._client = FakeOpenAI(args.llm_latency)
+    if args.fake_embedder:
+        pipeline._embed_model = FakeEmbedder()
+
+    results = []
+    for pages in args.pages:
+        for figures in args.figures:
+            pdf_path = os.path.join(_TMP, f"synthetic_{pages}p_{figures}f.pdf")
+            make_pdf(pdf_path, pages, figures, seed=pages * 100 + figures)
+            results.extend(bench_document(pdf_path, pages, figures, args.repeat))
+
+    print(f"{'pages':>5} {'fig/p':>5}  {'stage':<22} {'seconds':>9} {'items':>6} {'rate':>14} {'peak RSS':>10}")
+    for r in results:
+        rate = f"{r['items_per_s']} {r['unit']}/s" if r["items_per_s"] is not None else "-"
+        print(f"{r['pages']:>5} {r['figures_per_page']:>5}  {r['stage']:<22} {r['seconds']:>9.4f} "
+              f"{r['items']:>6} {rate:>14} {r['peak_rss_mb']:>8.1f}MB")
+
+    backend_rows = []
+    for n in args.index_vectors:
+        backend_rows.extend(bench_backends(n))
+    if backend_rows:
+        print(f"\n{'vectors':>8}  {'backend':<12} {'recall@5':>9} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8} {'size MB':>8}")
+        for r in backend_rows:
+            print(f"{r['vectors']:>8}  {r['backend']:<12} {r['recall@5']:>9.3f} {r['query_ms_p50']:>8.3f} "
+                  f"{r['query_ms_p95']:>8.3f} {r['build_s']:>8.2f} {r['index_mb']:>8.2f}")
+
+    if args.json:
+        meta = {"python": platform.python_version(), "machine": platform.machine(), "args": vars(args)}
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results, "index_backends": backend_rows}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# check_llm_gateway.py
+# Runs llm_gateway against a local mock of the OpenAI chat completions API
+# and checks retries, Retry-After, coalescing and the in-flight cap.
+#
+#   cd Research_Paper_Chatbot
+#   python benchmarks/check_llm_gateway.py
+#
+# No network and no API key needed; exits non-zero if a check fails.
+import os, sys, json, time, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class MockState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.open_streams = 0
+        self.max_open_streams = 0
+
+    def count(self, scenario: str) -> int:
+        with self.lock:
+            self.requests[scenario] = self.requests.get(scenario, 0) + 1
+            return self.requests[scenario]
+
+
+STATE = MockState()
+
+
+def _completion(content: str) -> dict:
+    return {
+        "id": "mock",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "mock",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def _chunk(content: str) -> dict:
+    return {
+        "id": "mock",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "mock",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # The scenario is the last user message: retry-429, bad-request, slow, stream.
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        scenario = body["messages"][-1]["content"].split(":")[0]
+        n = STATE.count(scenario)
+
+        if scenario == "retry-429" and n <= 2:
+            return self._json(429, {"error": {"message": "rate limited"}}, {"Retry-After": "0.2"})
+        if scenario == "bad-request":
+            return self._json(400, {"error": {"message": "bad request"}})
+        if scenario == "slow":
+            time.sleep(0.5)
+        if scenario == "stream":
+            return self._stream()
+        return self._json(200, _completion(f"{scenario} #{n}"))
+
+    def _json(self, status: int, payload: dict, headers: dict | None = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self):
+        with STATE.lock:
+            STATE.open_streams += 1
+            STATE.max_open_streams = max(STATE.max_open_streams, STATE.open_streams)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for piece in ("a", "b", "c", "d"):
+                self.wfile.write(f"data: {json.dumps(_chunk(piece))}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(0.1)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        finally:
+            with STATE.lock:
+                STATE.open_streams -= 1
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def check(name: str, ok: bool, detail: str) -> bool:
+    print(f"[CHECK] {'ok  ' if ok else 'FAIL'} {name}: {detail}")
+    return ok
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ["LLM_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    os.environ["LLM_RATE_PER_S"] = "0"
+    os.environ["LLM_MAX_IN_FLIGHT"] = "2"
+    import llm_gateway
+
+    def ask(content: str, **kwargs):
+        return llm_gateway.chat(model="mock", messages=[{"role": "user", "content": content}], **kwargs)
+
+    results = []
+
+    # 429 twice with Retry-After: 0.2, then success on the third attempt.
+    start = time.perf_counter()
+    res = ask("retry-429")
+    elapsed = time.perf_counter() - start
+    results.append(check(
+        "retry on 429 honours Retry-After",
+        STATE.requests["retry-429"] == 3 and elapsed >= 0.4 and res.choices[0].message.content == "retry-429 #3",
+        f"{STATE.requests['retry-429']} requests in {elapsed:.2f}s",
+    ))
+
+    # 400 is not retried.
+    try:
+        ask("bad-request")
+        raised = False
+    except Exception:
+        raised = True
+    results.append(check(
+        "no retry on 400",
+        raised and STATE.requests["bad-request"] == 1,
+        f"{STATE.requests['bad-request']} requests",
+    ))
+
+    # Identical concurrent calls share one upstream request.
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(ask("slow").choices[0].message.content)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.append(check(
+        "identical concurrent calls coalesce",
+        STATE.requests["slow"] == 1 and len(answers) == 8 and len(set(answers)) == 1,
+        f"8 callers, {STATE.requests['slow']} upstream requests",
+    ))
+
+    # Streams hold their in-flight slot until the body is consumed.
+    def consume(i: int):
+        stream = llm_gateway.chat_stream(model="mock", messages=[{"role": "user", "content": f"stream:{i}"}])
+        "".join(c.choices[0].delta.content or "" for c in stream if c.choices)
+
+    threads = [threading.Thread(target=consume, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.append(check(
+        "LLM_MAX_IN_FLIGHT bounds open streams",
+        STATE.requests["stream"] == 6 and STATE.max_open_streams <= 2,
+        f"6 streams, at most {STATE.max_open_streams} open at once (limit 2)",
+    ))
+
+    server.shutdown()
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
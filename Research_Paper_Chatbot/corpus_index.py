@@ -0,0 +1,317 @@
+# corpus_index.py
+# Semantic search across every stored paper (papers table + papers-pdf-private
+# bucket), next to the per-upload indexes of the chatbot.
+#
+#   python corpus_index.py            # embed papers not indexed yet
+#   python corpus_index.py --limit 50
+#
+# Run it after the ingestion scripts (e.g. from the same cron job). Text
+# chunk vectors go into append-only shards of CORPUS_SHARD_SIZE vectors;
+# only the newest shard is ever rewritten, and manifest.json (written last)
+# records which paper occupies which rows of which shard.
+import os, json, time, argparse, tempfile, threading
+
+import numpy as np
+import faiss
+
+import metrics
+from index_store import INDEX_CACHE_DIR, pdf_sha256, open_index, has_current_index, read_faiss_index
+from pages import extract_page_texts
+from paper_store import get_supabase, fetch_stored_papers, download_pdf, paper_hash
+
+
+CORPUS_DIR = os.getenv("CORPUS_DIR", os.path.join(INDEX_CACHE_DIR, "corpus"))
+CORPUS_SHARD_SIZE = int(os.getenv("CORPUS_SHARD_SIZE", "50000"))
+CORPUS_SAVE_EVERY = 20  # papers between manifest writes during an update
+SNIPPET_CHARS = 300
+
+_cache = {"mtime": None, "manifest": None, "shards": {}}
+_cache_lock = threading.Lock()
+
+
+def _manifest_path() -> str:
+    return os.path.join(CORPUS_DIR, "manifest.json")
+
+
+def _shard_paths(name: str) -> tuple[str, str]:
+    base = os.path.join(CORPUS_DIR, name)
+    return base + ".faiss", base + ".json"
+
+
+def _atomic_write(path: str, write) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _write_json(path: str, data) -> None:
+    def write(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+    _atomic_write(path, write)
+
+
+def load_manifest() -> dict:
+    """{ embed_model, papers: { paper_id: {...} }, shards: [{ name, count }] }; empty if nothing is indexed."""
+    try:
+        with open(_manifest_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"embed_model": None, "papers": {}, "shards": []}
+
+
+def _paper_chunks(pdf_path: str | None, content_hash: str) -> tuple[list[dict], np.ndarray | None]:
+    """Text chunks of a paper, plus their vectors when a chatbot index for it already exists."""
+    import pipeline
+
+    # Vectors from another model would not match the corpus manifest's embed_model.
+    stored = open_index(content_hash, embed_model=pipeline.EMBED_MODEL_NAME)
+    if stored is not None:
+        rows = [i for i, d in enumerate(stored["all_docs"]) if d["type"] == "text"]
+        chunks = [stored["all_docs"][i] for i in rows]
+        try:
+            vectors = stored["index"].reconstruct_n(0, stored["index"].ntotal)[rows]
+            return chunks, vectors
+        except Exception:
+            return chunks, None
+
+    page_texts = pipeline.fill_empty_pages(pdf_path, extract_page_texts(pdf_path))
+    full_text = pipeline.clean_text(page_texts)
+    return [{"content": full_text[s:e], "start": s, "end": e} for s, e in pipeline.chunk_spans(full_text)], None
+
+
+class _ShardWriter:
+    """Appends vectors to the newest shard, starting a new one when it is full."""
+
+    def __init__(self, manifest: dict):
+        self.manifest = manifest
+        self.shard = None  # manifest entry being appended to; added on the first add()
+        self.index = None
+        self.rows: list[dict] = []
+        if manifest["shards"] and manifest["shards"][-1]["count"] == 0:
+            # Listed by an older run that never wrote a vector into it.
+            manifest["shards"].pop()
+        last = manifest["shards"][-1] if manifest["shards"] else None
+        if last and last["count"] < CORPUS_SHARD_SIZE:
+            index_path, rows_path = _shard_paths(last["name"])
+            self.shard = last
+            self.index = faiss.read_index(index_path)
+            with open(rows_path, "r", encoding="utf-8") as f:
+                self.rows = json.load(f)
+            if self.index.ntotal > last["count"]:
+                # Rows flushed by a run that died before writing the manifest.
+                self.index.remove_ids(faiss.IDSelectorRange(last["count"], self.index.ntotal))
+                self.rows = self.rows[:last["count"]]
+
+    def _new_shard(self) -> None:
+        name = f"shard-{len(self.manifest['shards']):04d}"
+        self.shard = {"name": name, "count": 0}
+        self.manifest["shards"].append(self.shard)
+        self.index = None
+        self.rows = []
+
+    def add(self, paper_id: str, chunks: list[dict], vectors: np.ndarray) -> dict:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).copy()
+        faiss.normalize_L2(vectors)
+        if self.shard is None:
+            self._new_shard()
+        elif self.shard["count"] + len(vectors) > CORPUS_SHARD_SIZE and self.rows:
+            self.flush()
+            self._new_shard()
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vectors.shape[1])
+
+        start = self.index.ntotal
+        self.index.add(vectors)
+        self.rows.extend(
+            {"paper_id": paper_id, "snippet": c["content"][:SNIPPET_CHARS], "start": c["start"]} for c in chunks
+        )
+        self.shard["count"] = self.index.ntotal
+        return {"shard": self.shard["name"], "rows": [start, self.index.ntotal]}
+
+    def flush(self) -> None:
+        # The shard's files are written before the manifest that lists it.
+        if self.index is None:
+            return
+        index_path, rows_path = _shard_paths(self.shard["name"])
+        _atomic_write(index_path, lambda tmp: faiss.write_index(self.index, tmp))
+        _write_json(rows_path, self.rows)
+
+
+def update_corpus(limit: int | None = None) -> int:
+    """Embed stored papers that are not in the corpus index yet; returns how many were added."""
+    import pipeline
+
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    manifest = load_manifest()
+    if manifest["embed_model"] not in (None, pipeline.EMBED_MODEL_NAME):
+        raise RuntimeError(
+            f"Corpus was embedded with {manifest['embed_model']}; delete {CORPUS_DIR} to rebuild with {pipeline.EMBED_MODEL_NAME}"
+        )
+    manifest["embed_model"] = pipeline.EMBED_MODEL_NAME
+
+    supa = get_supabase()
+    todo = [p for p in fetch_stored_papers(supa) if str(p["id"]) not in manifest["papers"]]
+    if limit is not None:
+        todo = todo[:limit]
+    print(f"[CORPUS] {len(manifest['papers'])} papers indexed, {len(todo)} to add")
+
+    writer = _ShardWriter(manifest)
+    model = pipeline.get_embed_model()
+    added = 0
+
+    for paper in todo:
+        paper_id = str(paper["id"])
+        try:
+            # Papers prebuilt for the chatbot are read from their index, no download.
+            content_hash = paper_hash(paper_id)
+            if content_hash and has_current_index(content_hash, pipeline.EMBED_MODEL_NAME):
+                chunks, vectors = _paper_chunks(None, content_hash)
+            else:
+                pdf_bytes = download_pdf(supa, paper["stored_pdf_path"])
+                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+                    f.write(pdf_bytes)
+                try:
+                    content_hash = pdf_sha256(f.name)
+                    chunks, vectors = _paper_chunks(f.name, content_hash)
+                finally:
+                    os.remove(f.name)
+            if not chunks:
+                print(f"[CORPUS] {paper_id}: no text, skipped")
+                continue
+            if vectors is None:
+                vectors = model.encode(
+                    [c["content"] for c in chunks], batch_size=pipeline.EMBED_BATCH_SIZE, convert_to_numpy=True
+                )
+        except Exception as e:
+            print(f"[CORPUS] {paper_id}: failed, will retry next run: {e}")
+            continue
+
+        location = writer.add(paper_id, chunks, vectors)
+        manifest["papers"][paper_id] = {
+            **location,
+            "content_hash": content_hash,
+            "title": paper.get("title"),
+            "main_field": paper.get("main_field"),
+            "sub_field": paper.get("sub_field"),
+            "indexed_at": time.time(),
+        }
+        added += 1
+        print(f"[CORPUS] {paper_id}: {len(chunks)} chunks -> {location['shard']}")
+
+        if added % CORPUS_SAVE_EVERY == 0:
+            writer.flush()
+            _write_json(_manifest_path(), manifest)
+
+    writer.flush()
+    _write_json(_manifest_path(), manifest)
+    print(f"[CORPUS] added {added} papers, {len(manifest['papers'])} in total")
+    return added
+
+
+def _load() -> tuple[dict, dict]:
+    # Re-read when the update job has written a new manifest.
+    try:
+        mtime = os.path.getmtime(_manifest_path())
+    except OSError:
+        return load_manifest(), {}
+
+    with _cache_lock:
+        if _cache["mtime"] != mtime:
+            manifest = load_manifest()
+            shards = {}
+            for shard in manifest["shards"]:
+                index_path, rows_path = _shard_paths(shard["name"])
+                if not os.path.exists(index_path):
+                    continue
+                index, _ = read_faiss_index(index_path)
+                with open(rows_path, "r", encoding="utf-8") as f:
+                    shards[shard["name"]] = (index, json.load(f))
+            _cache.update(mtime=mtime, manifest=manifest, shards=shards)
+        return _cache["manifest"], _cache["shards"]
+
+
+def search_corpus(
+    query: str,
+    k: int = 10,
+    main_field: str | None = None,
+    sub_field: str | None = None,
+    q_emb=None,
+) -> list[dict]:
+    """Top k papers for query across the whole corpus, best matching chunk first.
+
+    Returns [{ paper_id, title, main_field, sub_field, score, snippet }].
+    With field filters only those papers' rows are searched.
+    """
+    manifest, shards = _load()
+    if not shards:
+        return []
+
+    if q_emb is None:
+        import pipeline
+        q_emb = pipeline.get_embed_model().encode([query])
+    q = np.ascontiguousarray(np.asarray(q_emb, dtype=np.float32).reshape(1, -1)).copy()
+    faiss.normalize_L2(q)
+
+    allowed = None
+    if main_field or sub_field:
+        allowed = {}
+        for paper in manifest["papers"].values():
+            if main_field and paper["main_field"] != main_field:
+                continue
+            if sub_field and paper["sub_field"] != sub_field:
+                continue
+            allowed.setdefault(paper["shard"], []).extend(range(*paper["rows"]))
+
+    # Several chunks per paper can match; fetch enough to fill k distinct papers.
+    per_shard = k * 8
+    hits = []
+    with metrics.timed("corpus_search"):
+        for name, (index, rows) in shards.items():
+            params = None
+            if allowed is not None:
+                ids = allowed.get(name)
+                if not ids:
+                    continue
+                params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(np.array(ids, dtype=np.int64)))
+            scores, ids = index.search(q, min(per_shard, index.ntotal), params=params)
+            hits.extend((float(s), rows[i]) for s, i in zip(scores[0], ids[0]) if i != -1)
+
+    results, seen = [], set()
+    for score, row in sorted(hits, key=lambda h: -h[0]):
+        paper = manifest["papers"].get(row["paper_id"])
+        if paper is None or row["paper_id"] in seen:
+            continue
+        seen.add(row["paper_id"])
+        results.append({
+            "paper_id": row["paper_id"],
+            "title": paper["title"],
+            "main_field": paper["main_field"],
+            "sub_field": paper["sub_field"],
+            "score": round(score, 4),
+            "snippet": row["snippet"],
+        })
+        if len(results) >= k:
+            break
+    return results
+
+
+def corpus_stats() -> dict:
+    manifest, shards = _load()
+    return {
+        "papers": len(manifest["papers"]),
+        "shards": len(manifest["shards"]),
+        "vectors": sum(s["count"] for s in manifest["shards"]),
+        "embed_model": manifest["embed_model"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add stored papers to the corpus-wide search index.")
+    parser.add_argument("--limit", type=int, help="at most this many new papers in this run")
+    args = parser.parse_args()
+    update_corpus(limit=args.limit)
+
+
+if __name__ == "__main__":
+    main()
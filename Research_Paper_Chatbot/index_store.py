@@ -0,0 +1,209 @@
+# index_store.py
+import os, re, json, hashlib, threading
+
+import faiss
+
+
+# Point INDEX_CACHE_DIR at a directory shared by all uvicorn workers (or
+# hosts, via a shared volume): any worker can then open a paper another one
+# indexed. Indexes are opened memory-mapped where FAISS supports it, so the
+# vectors live once in the OS page cache instead of in every worker's heap.
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", "index_cache")
+os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+
+INDEX_MMAP = os.getenv("INDEX_MMAP", "1") == "1"
+
+# Bump whenever chunking, figure prompts or the embedding model change,
+# so indexes built by an older pipeline are rebuilt instead of reused.
+INDEX_CACHE_VERSION = 3  # 2: text docs carry start/end offsets, 3: figure/table refs
+
+# Entries written before the embedding model was recorded all used this one.
+DEFAULT_EMBED_MODEL = "all-MiniLM-L6-v2"
+
+
+def pdf_sha256(pdf_path: str) -> str:
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_store_key(key: str) -> bool:
+    # Keys are SHA-256 hex digests; anything else never touches the disk.
+    return bool(re.fullmatch(r"[0-9a-f]{64}", key or ""))
+
+
+def read_faiss_index(index_path: str):
+    """Read a FAISS file (memory-mapped when INDEX_MMAP); returns (index, mapped).
+
+    Falls back to a normal read if mmap is unsupported for the index type.
+    """
+    if INDEX_MMAP:
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None) or faiss.IO_FLAG_MMAP
+        try:
+            return faiss.read_index(index_path, flag | faiss.IO_FLAG_READ_ONLY), True
+        except Exception as e:
+            print(f"[INDEX_CACHE] mmap not supported for {index_path}, reading into memory: {e}")
+    return faiss.read_index(index_path), False
+
+
+def _paths(key: str) -> tuple[str, str]:
+    base = os.path.join(INDEX_CACHE_DIR, key)
+    return base + ".faiss", base + ".json"
+
+
+def _info_path(key: str) -> str:
+    # A few bytes describing the entry, so batch jobs can check it without
+    # reading all_docs or the vectors.
+    return os.path.join(INDEX_CACHE_DIR, key + ".info.json")
+
+
+def _write_info(key: str, info: dict) -> None:
+    path = _info_path(key)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    os.replace(tmp, path)
+
+
+def save_index(
+    key: str,
+    all_docs: list[dict],
+    index,
+    refs: dict | None = None,
+    backend: str = "flat",
+    complete: bool = True,
+    embed_model: str = DEFAULT_EMBED_MODEL,
+) -> None:
+    # complete=False: some figure descriptions failed; the entry is served
+    # but build_index rebuilds it on the next upload of the same PDF.
+    index_path, meta_path = _paths(key)
+
+    # Write to temp files and rename, so a crash or a concurrent reader
+    # never sees a half-written entry. The metadata file goes last and
+    # marks the entry as complete.
+    tmp_index = f"{index_path}.{os.getpid()}.tmp"
+    faiss.write_index(index, tmp_index)
+    os.replace(tmp_index, index_path)
+
+    info = {"version": INDEX_CACHE_VERSION, "backend": backend, "embed_model": embed_model, "complete": complete}
+    tmp_meta = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        json.dump({**info, "all_docs": all_docs, "refs": refs or {}}, f)
+    os.replace(tmp_meta, meta_path)
+    _write_info(key, info)
+
+
+def index_info(key: str) -> dict | None:
+    """{ "version", "backend", "embed_model", "complete" } of a stored entry without opening it, or None."""
+    if not is_store_key(key):
+        return None
+    try:
+        with open(_info_path(key), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    # Entries saved before the info file existed: read the metadata once.
+    index_path, meta_path = _paths(key)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    info = {
+        "version": meta.get("version"),
+        "backend": meta.get("backend", "flat"),
+        "embed_model": meta.get("embed_model", DEFAULT_EMBED_MODEL),
+        "complete": meta.get("complete", True),
+    }
+    _write_info(key, info)
+    return info
+
+
+def has_current_index(key: str, embed_model: str, backend: str | None = None) -> bool:
+    """True if key has a complete entry that build_index would reuse as is (cheap: reads the info file only)."""
+    info = index_info(key)
+    return (
+        info is not None
+        and info["version"] == INDEX_CACHE_VERSION
+        and info["embed_model"] == embed_model
+        and info["complete"]
+        and (backend is None or info["backend"] == backend)
+    )
+
+
+def open_index(key: str, embed_model: str | None = None) -> dict | None:
+    """Return { "all_docs", "index", "mapped", "refs", "backend", "embed_model", "complete" } for a cached PDF hash, or None on a miss.
+
+    With embed_model, an index embedded by another model is a miss: its
+    vectors are not comparable with queries embedded by the current one.
+    """
+    if not is_store_key(key):
+        return None
+    index_path, meta_path = _paths(key)
+    if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+        return None
+
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_CACHE_VERSION:
+            return None
+        if embed_model is not None and meta.get("embed_model", DEFAULT_EMBED_MODEL) != embed_model:
+            print(f"[INDEX_CACHE] {key} was embedded with {meta.get('embed_model', DEFAULT_EMBED_MODEL)}, not {embed_model}")
+            return None
+        index, mapped = read_faiss_index(index_path)
+    except Exception as e:
+        print(f"[INDEX_CACHE] failed to load {key}: {e}")
+        return None
+
+    return {
+        "all_docs": meta["all_docs"],
+        "index": index,
+        "mapped": mapped,
+        "refs": meta.get("refs", {}),
+        "backend": meta.get("backend", "flat"),
+        "embed_model": meta.get("embed_model", DEFAULT_EMBED_MODEL),
+        "complete": meta.get("complete", True),
+    }
+
+
+# Figure descriptions, one small JSON file per crop fingerprint. Both
+# accepted descriptions and "not a scientific figure" rejections are stored.
+FIGURE_CACHE_DIR = os.getenv("FIGURE_CACHE_DIR", os.path.join(INDEX_CACHE_DIR, "figures"))
+
+
+def figure_key(image_bytes: bytes, model: str, prompt_version: int) -> str:
+    h = hashlib.sha256(image_bytes)
+    h.update(f"|{model}|{prompt_version}".encode())
+    return h.hexdigest()
+
+
+def _figure_path(key: str) -> str:
+    return os.path.join(FIGURE_CACHE_DIR, key[:2], key + ".json")
+
+
+def load_figure(key: str) -> dict | None:
+    """Return { "description" } for a cached crop, or None.
+
+    Rejections are stored as the NOT_A_FIGURE reply itself, which
+    build_index filters out for cached and fresh descriptions alike.
+    """
+    try:
+        with open(_figure_path(key), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_figure(key: str, description: str) -> None:
+    path = _figure_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"description": description}, f)
+    os.replace(tmp, path)
@@ -0,0 +1,219 @@
+# jobs.py
+# Background indexing jobs, so /upload can return before build_index finishes.
+import os, re, json, time, uuid, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import build_index
+from index_store import INDEX_CACHE_DIR, is_store_key
+
+
+INDEX_JOB_WORKERS = int(os.getenv("INDEX_JOB_WORKERS", "2"))
+JOB_TTL_S = int(os.getenv("JOB_TTL_S", "3600"))
+
+# Job records are mirrored to the shared store, so /jobs/{id} and the
+# "still indexing" check work no matter which worker the request lands on.
+JOBS_DIR = os.path.join(INDEX_CACHE_DIR, "jobs")
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+# job_id -> { job_id, doc_id, status, stage, percent, docs_in_index, error,
+#             created_at, updated_at }
+_jobs: dict[str, dict] = {}
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=INDEX_JOB_WORKERS, thread_name_prefix="index-job")
+
+
+def _job_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def _active_path(doc_id: str) -> str:
+    # Present while some worker is indexing doc_id; holds that job's id.
+    return os.path.join(JOBS_DIR, f"active-{doc_id}")
+
+
+def _write_job(job: dict) -> None:
+    path = _job_path(job["job_id"])
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f)
+    os.replace(tmp, path)
+
+
+def _read_job(job_id: str) -> dict | None:
+    try:
+        with open(_job_path(job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _update(job_id: str, **fields) -> None:
+    with _jobs_lock:
+        _jobs[job_id].update(fields, updated_at=time.time())
+        job = dict(_jobs[job_id])
+    _write_job(job)
+
+
+def _prune_finished() -> None:
+    cutoff = time.time() - JOB_TTL_S
+    for job_id in [j for j, job in _jobs.items() if job["status"] in ("done", "failed") and job["updated_at"] < cutoff]:
+        del _jobs[job_id]
+        try:
+            os.remove(_job_path(job_id))
+        except OSError:
+            pass
+
+
+def _marker_job_id(doc_id: str) -> str | None:
+    try:
+        with open(_active_path(doc_id), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _claim_doc(doc_id: str, job_id: str) -> str | None:
+    """Mark doc_id as being indexed by job_id; return the other job's id if already claimed."""
+    if not is_store_key(doc_id):
+        return None
+
+    path = _active_path(doc_id)
+    # The marker is created by link(), so it never exists without the job id
+    # in it, and link() fails if another worker's marker is already there.
+    tmp = f"{path}.{job_id}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(job_id)
+    try:
+        for _ in range(3):
+            try:
+                os.link(tmp, path)
+                return None
+            except FileExistsError:
+                pass
+
+            holder = _marker_job_id(doc_id)
+            if holder is None:
+                continue  # released meanwhile
+            other = find_active_job(doc_id)
+            if other is not None:
+                return other["job_id"]
+
+            # Stale marker (its worker died). Only one worker's rename of it
+            # succeeds; if what we moved is not the marker we judged stale,
+            # another worker claimed the paper in between, so put it back.
+            stale = f"{path}.{job_id}.stale"
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                continue
+            with open(stale, "r", encoding="utf-8") as f:
+                moved = f.read().strip()
+            if moved != holder:
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return moved
+            os.remove(stale)
+        return holder
+    finally:
+        os.remove(tmp)
+
+
+def _release_doc(doc_id: str, job_id: str) -> None:
+    # Only our own marker; a job that stalled past JOB_TTL_S may have lost it.
+    if _marker_job_id(doc_id) != job_id:
+        return
+    try:
+        os.remove(_active_path(doc_id))
+    except OSError:
+        pass
+
+
+def _run(job_id: str, pdf_path: str, doc_id: str, content_hash: str | None) -> None:
+    _update(job_id, status="running", stage="starting", percent=0)
+
+    def progress(stage: str, percent: float) -> None:
+        _update(job_id, stage=stage, percent=round(percent, 1))
+
+    try:
+        num_docs = build_index(pdf_path, doc_id=doc_id, content_hash=content_hash, progress=progress)
+    except Exception as e:
+        print(f"[JOBS] {job_id} failed: {e}")
+        _update(job_id, status="failed", stage="failed", error=str(e))
+        return
+    finally:
+        _release_doc(doc_id, job_id)
+
+    _update(job_id, status="done", stage="done", percent=100, docs_in_index=num_docs)
+
+
+def submit_index_job(pdf_path: str, doc_id: str, content_hash: str | None = None) -> dict:
+    """Queue build_index for a PDF and return the job record.
+
+    If the same doc_id is already queued or running, in this worker or in
+    another one sharing the store, that job is returned instead of indexing
+    the paper twice.
+    """
+    with _jobs_lock:
+        _prune_finished()
+        for job in _jobs.values():
+            if job["doc_id"] == doc_id and job["status"] in ("queued", "running"):
+                return dict(job)
+
+    now = time.time()
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "doc_id": doc_id,
+        "status": "queued",
+        "stage": "queued",
+        "percent": 0,
+        "docs_in_index": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+    # Written before claiming, so other workers never see a marker without a record.
+    _write_job(job)
+    other_job_id = _claim_doc(doc_id, job["job_id"])
+    if other_job_id is not None:
+        other = get_job(other_job_id)
+        if other is not None:
+            os.remove(_job_path(job["job_id"]))
+            return other
+
+    with _jobs_lock:
+        _jobs[job["job_id"]] = job
+
+    _executor.submit(_run, job["job_id"], pdf_path, doc_id, content_hash)
+    return dict(job)
+
+
+def get_job(job_id: str) -> dict | None:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job:
+            return dict(job)
+    # Possibly started by another worker.
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    return _read_job(job_id)
+
+
+def find_active_job(doc_id: str) -> dict | None:
+    with _jobs_lock:
+        for job in _jobs.values():
+            if job["doc_id"] == doc_id and job["status"] in ("queued", "running"):
+                return dict(job)
+
+    if not is_store_key(doc_id):
+        return None
+    holder = _marker_job_id(doc_id)
+    job = _read_job(holder) if holder else None
+
+    # A job that has not reported progress for JOB_TTL_S belonged to a dead worker.
+    if job and job["status"] in ("queued", "running") and job["updated_at"] > time.time() - JOB_TTL_S:
+        return job
+    return None
@@ -0,0 +1,193 @@
+# llm_gateway.py
+# Every OpenAI call goes through here: one pooled client, a token-bucket
+# rate limit, a cap on in-flight requests, retries with backoff on
+# 429/5xx/connection errors, and single-flight coalescing so identical
+# concurrent requests share one upstream call.
+import os, json, time, random, hashlib, threading
+
+import metrics
+
+
+# LLM_BASE_URL (or OPENAI_BASE_URL, which the SDK reads itself) can point
+# at a local mock server in tests.
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+LLM_RATE_PER_S = float(os.getenv("LLM_RATE_PER_S", "8"))
+LLM_BURST = int(os.getenv("LLM_BURST", "16"))
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+_client = None
+_client_lock = threading.Lock()
+_in_flight = threading.BoundedSemaphore(LLM_MAX_IN_FLIGHT)
+
+# key -> { "event", "result", "error" } for calls currently running upstream.
+_pending: dict[str, dict] = {}
+_pending_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, at most `burst` saved up."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until one is available; returns seconds waited."""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+_bucket = TokenBucket(LLM_RATE_PER_S, LLM_BURST)
+
+
+def get_client():
+    """The shared OpenAI client, backed by one pooled HTTP connection pool."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from openai import OpenAI
+
+                http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                    ),
+                    timeout=LLM_TIMEOUT_S,
+                )
+                # Retries are done here, not by the SDK.
+                _client = OpenAI(base_url=LLM_BASE_URL, max_retries=0, timeout=LLM_TIMEOUT_S, http_client=http_client)
+    return _client
+
+
+def _is_retryable(err: Exception) -> bool:
+    import openai
+
+    if isinstance(err, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(err, openai.APIStatusError):
+        return err.status_code in RETRY_STATUS
+    return False
+
+
+def _retry_after(err: Exception) -> float | None:
+    response = getattr(err, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _call(kwargs: dict, timeout: float | None, max_retries: int, hold_slot: bool = False):
+    """create() with rate limit, in-flight cap and retries.
+
+    With hold_slot the in-flight slot is still held on return; the caller
+    releases it once the response (a stream) has been consumed.
+    """
+    client = get_client()
+    api = client if timeout is None else client.with_options(timeout=timeout)
+
+    for attempt in range(max_retries + 1):
+        waited = _bucket.acquire()
+        if waited:
+            metrics.observe("chatbot_stage_seconds", waited, stage="llm_rate_limit_wait")
+        _in_flight.acquire()
+        try:
+            res = api.chat.completions.create(**kwargs)
+            if not hold_slot:
+                _in_flight.release()
+            return res
+        except Exception as e:
+            _in_flight.release()
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            delay = _retry_after(e) or min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.8, 1.2)
+            metrics.inc("chatbot_llm_retries_total", model=kwargs.get("model", ""))
+            print(f"[LLM_GATEWAY] attempt {attempt + 1}/{max_retries + 1} failed ({e}); retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _request_key(kwargs: dict) -> str:
+    payload = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def chat(timeout: float | None = None, max_retries: int | None = None, **kwargs):
+    """chat.completions.create through the gateway (non-streaming).
+
+    Concurrent calls with identical kwargs wait for the first one and get
+    the same response object.
+    """
+    max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+    key = _request_key(kwargs)
+
+    with _pending_lock:
+        call = _pending.get(key)
+        leader = call is None
+        if leader:
+            call = _pending[key] = {"event": threading.Event(), "result": None, "error": None}
+
+    if not leader:
+        metrics.inc("chatbot_llm_coalesced_total", model=kwargs.get("model", ""))
+        call["event"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    try:
+        call["result"] = _call(kwargs, timeout, max_retries)
+        metrics.record_usage(kwargs.get("model", ""), getattr(call["result"], "usage", None))
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _pending_lock:
+            _pending.pop(key, None)
+        call["event"].set()
+
+
+def chat_stream(timeout: float | None = None, max_retries: int | None = None, **kwargs):
+    """Streaming chat.completions.create through the gateway.
+
+    Streams are never coalesced; retries only cover opening the stream.
+    Token usage is recorded from the final chunk when the caller asked for
+    stream_options={"include_usage": True}.
+    """
+    max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+    # create() returns once the headers arrive; the slot is held until the
+    # body is read, so LLM_MAX_IN_FLIGHT also bounds streamed answers.
+    stream = _call({**kwargs, "stream": True}, timeout, max_retries, hold_slot=True)
+
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                metrics.record_usage(kwargs.get("model", ""), chunk.usage)
+            yield chunk
+    finally:
+        _in_flight.release()
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
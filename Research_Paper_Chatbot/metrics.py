@@ -0,0 +1,129 @@
+# metrics.py
+# Minimal in-process histograms and counters, rendered in the Prometheus
+# text format by GET /metrics. Values are per worker process.
+import time, threading
+from contextlib import contextmanager
+
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+HELP = {
+    "chatbot_stage_seconds": "Time spent per pipeline stage.",
+    "chatbot_llm_tokens": "Tokens per LLM call.",
+    "chatbot_llm_tokens_total": "Tokens sent to / received from the LLM.",
+    "chatbot_context_tokens": "Estimated tokens of retrieved context per question.",
+    "chatbot_context_source_total": "Questions answered from the figure/table reference index vs. vector search.",
+    "chatbot_cache_requests_total": "Cache lookups by cache and result (hit/miss).",
+    "chatbot_cache_hit_ratio": "Hits / lookups per cache since process start.",
+    "chatbot_llm_retries_total": "LLM calls retried after a 429/5xx/connection error.",
+    "chatbot_llm_coalesced_total": "LLM calls served by an identical request already in flight.",
+}
+
+# (name, sorted label items) -> { "buckets": tuple, "counts": list, "sum": float, "count": int }
+_histograms: dict[tuple, dict] = {}
+# (name, sorted label items) -> value
+_counters: dict[tuple, float] = {}
+_lock = threading.Lock()
+
+
+def observe(name: str, value: float, buckets: tuple = SECONDS_BUCKETS, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, upper in enumerate(h["buckets"]):
+            if value <= upper:
+                h["counts"][i] += 1
+        h["sum"] += value
+        h["count"] += 1
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("chatbot_stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+def record_cache(cache: str, hit: bool, amount: int = 1) -> None:
+    if amount:
+        inc("chatbot_cache_requests_total", amount, cache=cache, result="hit" if hit else "miss")
+
+
+def record_usage(model: str, usage) -> None:
+    """Record token counts from an OpenAI `usage` object (may be None)."""
+    if usage is None:
+        return
+    for kind, value in (("prompt", usage.prompt_tokens), ("completion", usage.completion_tokens)):
+        if value is None:
+            continue
+        observe("chatbot_llm_tokens", value, buckets=TOKEN_BUCKETS, model=model, kind=kind)
+        inc("chatbot_llm_tokens_total", value, model=model, kind=kind)
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached:
+        inc("chatbot_llm_tokens_total", cached, model=model, kind="prompt_cached")
+
+
+def _fmt_labels(items) -> str:
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _type_line(lines: list[str], seen: set, name: str, kind: str) -> None:
+    if name not in seen:
+        seen.add(name)
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def render() -> str:
+    lines: list[str] = []
+    seen: set = set()
+
+    with _lock:
+        histograms = {k: dict(v, counts=list(v["counts"])) for k, v in _histograms.items()}
+        counters = dict(_counters)
+
+    for (name, items), h in sorted(histograms.items()):
+        _type_line(lines, seen, name, "histogram")
+        for upper, count in zip(h["buckets"], h["counts"]):
+            lines.append(f"{name}_bucket{_fmt_labels(items + (('le', upper),))} {count}")
+        lines.append(f"{name}_bucket{_fmt_labels(items + (('le', '+Inf'),))} {h['count']}")
+        lines.append(f"{name}_sum{_fmt_labels(items)} {h['sum']}")
+        lines.append(f"{name}_count{_fmt_labels(items)} {h['count']}")
+
+    for (name, items), value in sorted(counters.items()):
+        _type_line(lines, seen, name, "counter")
+        lines.append(f"{name}{_fmt_labels(items)} {value}")
+
+    # Derived hit ratio per cache, for dashboards that do not compute rates.
+    lookups: dict[str, list[float]] = {}
+    for (name, items), value in counters.items():
+        if name == "chatbot_cache_requests_total":
+            labels = dict(items)
+            hits_total = lookups.setdefault(labels["cache"], [0.0, 0.0])
+            hits_total[1] += value
+            if labels["result"] == "hit":
+                hits_total[0] += value
+    for cache, (hits, total) in sorted(lookups.items()):
+        _type_line(lines, seen, "chatbot_cache_hit_ratio", "gauge")
+        lines.append(f'chatbot_cache_hit_ratio{{cache="{cache}"}} {hits / total if total else 0.0}')
+
+    return "\n".join(lines) + "\n"
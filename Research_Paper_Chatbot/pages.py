@@ -0,0 +1,226 @@
+# pages.py
+# Page rendering and figure detection. Kept free of model/API imports so
+# process-pool workers can import it cheaply.
+import os, math, time, threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+import cv2
+import numpy as np
+
+import metrics
+
+
+# 0 or 1 = render and detect pages in the calling process.
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", "0"))
+
+# "full": detect on the full-dpi page. "thumbnail": find boxes on a DETECT_DPI
+# render, then re-render only those regions at full dpi for the crops; faster,
+# but thin plot lines fade above the fixed gray threshold at low dpi and whole
+# figures can be missed, so it stays opt-in until both modes find the same boxes.
+DETECT_MODE = os.getenv("DETECT_MODE", "full")
+DETECT_DPI = int(os.getenv("DETECT_DPI", "50"))
+
+_page_pool: ProcessPoolExecutor | None = None
+_page_pool_workers = 0
+_page_pool_lock = threading.Lock()
+
+
+def pixmap_array(pix) -> np.ndarray:
+    """RGB NumPy view over a pixmap's samples, valid while the pixmap lives."""
+    samples = getattr(pix, "samples_mv", None) or pix.samples
+    return np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+def iter_page_images(pdf_path: str, dpi: int = 200, pages: list[int] | None = None):
+    """Yield { "page", "image", "pixmap" } one page at a time.
+
+    "image" is an RGB NumPy view over the pixmap samples (no PNG encode or
+    copy); it is only valid while "pixmap" is alive, i.e. until the next
+    page is requested. `pages` restricts rendering to those 1-based page
+    numbers.
+    """
+    zoom = dpi / 72
+    mat = fitz.Matrix(zoom, zoom)
+
+    with fitz.open(pdf_path) as doc:
+        for page_no in pages if pages is not None else range(1, doc.page_count + 1):
+            pix = doc[page_no - 1].get_pixmap(matrix=mat, alpha=False)
+            img = pixmap_array(pix)
+            yield {"page": page_no, "image": img, "pixmap": pix}
+            del img, pix
+
+
+def detect_visual_blocks(img: np.ndarray):
+    # img is RGB pixmap samples (pixmap_array), used as-is without a PNG round trip.
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    h, w = img.shape[:2]
+    boxes = []
+    for c in contours:
+        x, y, bw, bh = cv2.boundingRect(c)
+        if bw * bh > 0.03 * w * h: 
+            boxes.append((x, y, bw, bh))
+    return boxes, img
+
+
+def crop_visual_blocks(page_img: np.ndarray) -> list[bytes]:
+    """PNG-encode every visual block detected on an RGB page image."""
+    boxes, img = detect_visual_blocks(page_img)
+    crops = []
+    for (x, y, w, h) in boxes:
+        crop = cv2.cvtColor(img[y : y + h, x : x + w], cv2.COLOR_RGB2BGR)
+        _, buf = cv2.imencode(".png", crop)
+        crops.append(buf.tobytes())
+    return crops
+
+
+def crop_visual_blocks_lowres(page, dpi: int = 200, detect_dpi: int = DETECT_DPI) -> tuple[list[bytes], float, float]:
+    """Detect boxes on a low-dpi thumbnail, crop each one at full dpi.
+
+    Returns (crops, detect_seconds, crop_seconds); detect_seconds includes
+    rendering the thumbnail. Expects an unrotated page.
+    """
+    start = time.perf_counter()
+    thumb = page.get_pixmap(matrix=fitz.Matrix(detect_dpi / 72, detect_dpi / 72), alpha=False)
+    boxes, _ = detect_visual_blocks(pixmap_array(thumb))
+    del thumb
+    detect_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    to_points = 72 / detect_dpi
+    zoom = dpi / 72
+    crops = []
+    for (x, y, w, h) in boxes:
+        # Pad by one thumbnail pixel to absorb rounding at the lower resolution.
+        clip = fitz.Rect(x - 1, y - 1, x + w + 1, y + h + 1) * to_points
+        clip &= page.rect
+        if clip.is_empty:
+            continue
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+        crop = cv2.cvtColor(pixmap_array(pix), cv2.COLOR_RGB2BGR)
+        _, buf = cv2.imencode(".png", crop)
+        crops.append(buf.tobytes())
+    return crops, detect_s, time.perf_counter() - start
+
+
+def extract_page_texts(pdf_path: str) -> list[str]:
+    """PyMuPDF word text of every page, without rendering anything."""
+    with fitz.open(pdf_path) as doc:
+        return [" ".join(w[4] for w in page.get_text("words")) for page in doc]
+
+
+def _process_pages(
+    pdf_path: str,
+    page_numbers: list[int] | None,
+    dpi: int,
+    with_text: bool,
+    detect_mode: str = DETECT_MODE,
+) -> list[dict]:
+    # Runs inside a pool worker (or inline when serial). One open document
+    # serves both text extraction and rendering. Timings are returned with
+    # the results so the parent process records them.
+    zoom = dpi / 72
+    mat = fitz.Matrix(zoom, zoom)
+    out = []
+
+    with fitz.open(pdf_path) as doc:
+        for page_no in page_numbers if page_numbers is not None else range(1, doc.page_count + 1):
+            page = doc[page_no - 1]
+            result = {"page": page_no, "text": None, "text_s": 0.0}
+
+            if with_text:
+                start = time.perf_counter()
+                words = page.get_text("words")
+                result["text"] = " ".join(w[4] for w in words)
+                result["text_s"] = time.perf_counter() - start
+
+            # Thumbnail boxes are mapped back in unrotated page space, so
+            # rotated pages use full-resolution detection.
+            if detect_mode == "thumbnail" and not page.rotation:
+                result["crops"], result["detect_s"], result["render_s"] = crop_visual_blocks_lowres(page, dpi)
+                out.append(result)
+                continue
+
+            start = time.perf_counter()
+            pix = page.get_pixmap(matrix=mat, alpha=False)
+            img = pixmap_array(pix)
+            result["render_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result["crops"] = crop_visual_blocks(img)
+            result["detect_s"] = time.perf_counter() - start
+
+            del img, pix
+            out.append(result)
+    return out
+
+
+def _get_page_pool(workers: int) -> ProcessPoolExecutor:
+    global _page_pool, _page_pool_workers
+
+    with _page_pool_lock:
+        if _page_pool is None or _page_pool_workers != workers:
+            if _page_pool is not None:
+                _page_pool.shutdown(wait=False)
+            # spawn: never fork a server process that already runs threads.
+            _page_pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"))
+            _page_pool_workers = workers
+        return _page_pool
+
+
+def process_pdf(
+    pdf_path: str,
+    dpi: int = 200,
+    workers: int | None = None,
+    with_text: bool = False,
+    detect_mode: str | None = None,
+) -> tuple[list[str] | None, list[tuple[int, bytes]]]:
+    """Read every page once: PyMuPDF text (optional) plus figure crops.
+
+    Returns (page_texts, crops): page_texts[i] is the raw word text of page
+    i + 1 (None when with_text is False) and crops is (page, png_bytes) for
+    every visual block. With workers > 1 pages are split into contiguous
+    ranges and processed in a process pool; results are merged back in page
+    order. detect_mode defaults to DETECT_MODE ("thumbnail" or "full").
+    """
+    workers = PAGE_WORKERS if workers is None else workers
+    detect_mode = detect_mode or DETECT_MODE
+
+    if workers <= 1:
+        per_page = _process_pages(pdf_path, None, dpi, with_text, detect_mode)
+    else:
+        with fitz.open(pdf_path) as doc:
+            n_pages = doc.page_count
+        # A few ranges per worker so one figure-heavy range does not stall the rest.
+        size = max(1, math.ceil(n_pages / (workers * 4)))
+        ranges = [list(range(start, min(start + size, n_pages + 1))) for start in range(1, n_pages + 1, size)]
+
+        pool = _get_page_pool(workers)
+        per_page = []
+        n = len(ranges)
+        for part in pool.map(_process_pages, [pdf_path] * n, ranges, [dpi] * n, [with_text] * n, [detect_mode] * n):
+            per_page.extend(part)
+
+    for r in per_page:
+        if with_text:
+            metrics.observe("chatbot_stage_seconds", r["text_s"], stage="page_text")
+        metrics.observe("chatbot_stage_seconds", r["render_s"], stage="page_render")
+        metrics.observe("chatbot_stage_seconds", r["detect_s"], stage="contour_detection")
+
+    page_texts = [r["text"] for r in per_page] if with_text else None
+    crops = [(r["page"], crop) for r in per_page for crop in r["crops"]]
+    return page_texts, crops
+
+
+def extract_figure_crops(
+    pdf_path: str,
+    dpi: int = 200,
+    workers: int | None = None,
+    detect_mode: str | None = None,
+) -> list[tuple[int, bytes]]:
+    """Return (page, png_bytes) for every visual block, in page order."""
+    return process_pdf(pdf_path, dpi=dpi, workers=workers, detect_mode=detect_mode)[1]
@@ -0,0 +1,90 @@
+# paper_store.py
+# Stored papers (Supabase papers table + papers-pdf-private bucket) and the
+# paper_id -> content hash map that lets /papers/{paper_id}/open find the
+# chatbot index prebuild_indexes.py built for a catalog paper.
+import os, re, json, threading
+
+from index_store import INDEX_CACHE_DIR
+
+
+PAPERS_BUCKET = "papers-pdf-private"
+
+# One small file per paper, so the prebuild job and the API workers never
+# rewrite a shared map.
+PAPER_MAP_DIR = os.path.join(INDEX_CACHE_DIR, "papers")
+os.makedirs(PAPER_MAP_DIR, exist_ok=True)
+
+_supabase = None
+_supabase_lock = threading.Lock()
+
+
+def get_supabase():
+    global _supabase
+    with _supabase_lock:
+        if _supabase is None:
+            from supabase import create_client
+            _supabase = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE_KEY"])
+        return _supabase
+
+
+def fetch_stored_papers(supa, page_size: int = 500) -> list[dict]:
+    papers, start = [], 0
+    while True:
+        res = (
+            supa.table("papers")
+            .select("id, title, main_field, sub_field, stored_pdf_path")
+            .not_.is_("stored_pdf_path", "null")
+            .order("id")
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        rows = res.data or []
+        papers.extend(rows)
+        if len(rows) < page_size:
+            return papers
+        start += page_size
+
+
+def fetch_paper(supa, paper_id: str) -> dict | None:
+    res = (
+        supa.table("papers")
+        .select("id, title, stored_pdf_path")
+        .eq("id", paper_id)
+        .limit(1)
+        .execute()
+    )
+    return res.data[0] if res.data else None
+
+
+def download_pdf(supa, stored_pdf_path: str) -> bytes:
+    return supa.storage.from_(PAPERS_BUCKET).download(stored_pdf_path)
+
+
+def is_paper_id(paper_id: str) -> bool:
+    # Paper ids become file names below; ints and UUIDs both pass.
+    return bool(re.fullmatch(r"[A-Za-z0-9_-]{1,64}", paper_id or ""))
+
+
+def _map_path(paper_id: str) -> str:
+    return os.path.join(PAPER_MAP_DIR, f"{paper_id}.json")
+
+
+def paper_hash(paper_id: str) -> str | None:
+    """Content hash (= doc_id) of the stored PDF of paper_id, if it was fetched before."""
+    if not is_paper_id(paper_id):
+        return None
+    try:
+        with open(_map_path(paper_id), "r", encoding="utf-8") as f:
+            return json.load(f)["content_hash"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_paper_hash(paper_id: str, content_hash: str, stored_pdf_path: str | None = None) -> None:
+    if not is_paper_id(paper_id):
+        raise ValueError(f"Invalid paper_id: {paper_id!r}")
+    path = _map_path(paper_id)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"content_hash": content_hash, "stored_pdf_path": stored_pdf_path}, f)
+    os.replace(tmp, path)
@@ -1,40 +1,108 @@
 # pipeline.py
-import os, io, base64, re
+import os, base64, re, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
 
 import pdfplumber
-import fitz
-import cv2
 import numpy as np
 
-from sentence_transformers import SentenceTransformer
-import faiss
-from openai import OpenAI
+import answer_cache
+import llm_gateway
+import metrics
+import sessions
+from references import build_refs, question_refs
+from vector_index import INDEX_BACKEND, build_vector_index, search as search_index, index_nbytes
+from pages import extract_figure_crops, process_pdf
+from index_store import (
+    pdf_sha256, open_index, save_index, is_store_key,
+    figure_key, load_figure, save_figure,
+)
 
 
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Per-document indexes, most recently used last. Each entry holds
+# { "doc_id", "pdf_path", "all_docs", "index", "mapped", "refs", "complete", "nbytes" }.
+# A miss falls back to the shared on-disk store (index_store), so any worker
+# can serve a paper that another worker indexed.
+INDEX_MEMORY_BUDGET_MB = int(os.getenv("INDEX_MEMORY_BUDGET_MB", "512"))
+_registry: "OrderedDict[str, dict]" = OrderedDict()
+_registry_lock = threading.RLock()
 
-CURRENT_PDF: str | None = None
-all_docs: list[dict] = []  
-index: faiss.IndexFlatL2 | None = None
+# Figure descriptions are dispatched concurrently during build_index.
+# "pymupdf": text comes from the same page pass as rendering (pdfplumber only
+# for pages that come back empty); "pdfplumber": the original extractor.
+TEXT_EXTRACTOR = os.getenv("TEXT_EXTRACTOR", "pymupdf")
 
-client = OpenAI()  
+FIGURE_CONCURRENCY = int(os.getenv("FIGURE_CONCURRENCY", "8"))
+FIGURE_TIMEOUT_S = float(os.getenv("FIGURE_TIMEOUT_S", "60"))
+FIGURE_RETRIES = int(os.getenv("FIGURE_RETRIES", "2"))
 
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
+NOT_A_FIGURE = "This image does not appear to be a scientific figure from the paper."
 
+# Part of the figure cache key: bump FIGURE_PROMPT_VERSION when the
+# describe_image prompt changes so stale descriptions are not reused.
+FIGURE_MODEL = "gpt-4o-mini"
+FIGURE_PROMPT_VERSION = 1
 
-def extract_text_clean(pdf_path: str) -> str:
-    full_text = ""
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+# Context packing (get_context): CONTEXT_CANDIDATES nearest chunks are
+# re-ranked with MMR (CONTEXT_MMR_LAMBDA = relevance vs. diversity) and added
+# until CONTEXT_TOKEN_BUDGET estimated tokens (~4 characters each) are used.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "900"))
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "20"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CHARS_PER_TOKEN = 4
+
+# Loaded on first use (or by warm_up) so importing this module stays cheap.
+# The OpenAI client lives in llm_gateway, which every LLM call goes through.
+_embed_model = None
+_embed_lock = threading.Lock()
+
+
+def get_client():
+    return llm_gateway.get_client()
+
+
+def get_embed_model():
+    global _embed_model
+    if _embed_model is None:
+        with _embed_lock:
+            if _embed_model is None:
+                from sentence_transformers import SentenceTransformer
+                print(f"[MODELS] loading {EMBED_MODEL_NAME}")
+                _embed_model = SentenceTransformer(EMBED_MODEL_NAME)
+    return _embed_model
+
+
+def warm_up() -> None:
+    """Load the embedder and the OpenAI client and run one tiny encode."""
+    get_client()
+    get_embed_model().encode(["warm up"], convert_to_numpy=True)
+    print("[MODELS] warm")
+
+
+def is_ready() -> bool:
+    return _embed_model is not None
+
+
+def _pdfplumber_page_texts(pdf_path: str, page_numbers: list[int] | None = None) -> dict[int, str]:
+    texts = {}
     with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            words = page.extract_words(
+        for page_no in page_numbers if page_numbers is not None else range(1, len(pdf.pages) + 1):
+            words = pdf.pages[page_no - 1].extract_words(
                 use_text_flow=True,
                 keep_blank_chars=False,
                 x_tolerance=2,
                 y_tolerance=2
             )
-            if words:
-                full_text += " ".join(w["text"] for w in words) + "\n"
+            texts[page_no] = " ".join(w["text"] for w in words)
+    return texts
+
+
+def clean_text(page_texts: list[str]) -> str:
+    full_text = "".join(t + "\n" for t in page_texts if t)
 
     full_text = re.sub(r"-\s*\n\s*", "", full_text)
     full_text = re.sub(r"\s+", " ", full_text).strip()
@@ -42,43 +110,41 @@ def extract_text_clean(pdf_path: str) -> str:
     return full_text
 
 
-def chunk_text(text: str, chunk_size: int = 600, overlap: int = 120) -> list[str]:
-    chunks, start = [], 0
-    n = len(text)
-    while start < n:
-        chunks.append(text[start:start+chunk_size])
-        start += max(1, chunk_size - overlap)
-    return chunks
+def extract_text_clean(pdf_path: str) -> str:
+    texts = _pdfplumber_page_texts(pdf_path)
+    return clean_text([texts[n] for n in sorted(texts)])
+
 
+def fill_empty_pages(pdf_path: str, page_texts: list[str]) -> list[str]:
+    """Re-extract pages PyMuPDF returned no text for with pdfplumber."""
+    empty = [i + 1 for i, t in enumerate(page_texts) if not t.strip()]
+    if not empty:
+        return page_texts
 
-def render_pages(pdf_path: str, dpi: int = 200) -> list[dict]:
-    doc = fitz.open(pdf_path)
-    zoom = dpi / 72
-    mat = fitz.Matrix(zoom, zoom)
-    pages = []
+    print(f"[EXTRACT_TEXT] pdfplumber fallback for pages {empty}")
+    fallback = _pdfplumber_page_texts(pdf_path, empty)
+    return [fallback.get(i + 1, t) if not t.strip() else t for i, t in enumerate(page_texts)]
 
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        pages.append({"page": i + 1, "image": pix.tobytes("png")})
-    return pages
 
+def chunk_spans(text: str, chunk_size: int = 600, overlap: int = 120) -> list[tuple[int, int]]:
+    spans, start = [], 0
+    n = len(text)
+    while start < n:
+        spans.append((start, min(n, start + chunk_size)))
+        start += max(1, chunk_size - overlap)
+    return spans
 
-def detect_visual_blocks(page_img: bytes):
-    img = cv2.imdecode(np.frombuffer(page_img, np.uint8), cv2.IMREAD_COLOR)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    h, w = img.shape[:2]
-    boxes = []
-    for c in contours:
-        x, y, bw, bh = cv2.boundingRect(c)
-        if bw * bh > 0.03 * w * h: 
-            boxes.append((x, y, bw, bh))
-    return boxes, img
+def chunk_text(text: str, chunk_size: int = 600, overlap: int = 120) -> list[str]:
+    return [text[s:e] for s, e in chunk_spans(text, chunk_size, overlap)]
 
 
-def describe_image(image_bytes: bytes, context: str | None = None) -> str:
+def describe_image(
+    image_bytes: bytes,
+    context: str | None = None,
+    timeout: float | None = None,
+    max_retries: int | None = None,
+) -> str:
     image_b64 = base64.b64encode(image_bytes).decode()
 
     user_content = [
@@ -90,7 +156,7 @@ def describe_image(image_bytes: bytes, context: str | None = None) -> str:
                 "Describe ONLY the scientific content of this figure or table "
                 "(axes, labels, distributions, trends, comparisons, etc.).\n"
                 "If the image is not a scientific figure/table/diagram, reply exactly:\n"
-                "\"This image does not appear to be a scientific figure from the paper.\""
+                f"\"{NOT_A_FIGURE}\""
             ),
         },
         {
@@ -99,82 +165,424 @@ def describe_image(image_bytes: bytes, context: str | None = None) -> str:
         },
     ]
 
-    res = client.chat.completions.create(
-        model="gpt-4o-mini",   
-        messages=[
-            {
-                "role": "system",
-                "content": "You describe scientific figures briefly and clearly.",
-            },
-            {"role": "user", "content": user_content},
-        ],
-        max_completion_tokens=300,
-    )
+    with metrics.timed("figure_description"):
+        res = llm_gateway.chat(
+            timeout=timeout,
+            max_retries=max_retries,
+            model=FIGURE_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You describe scientific figures briefly and clearly.",
+                },
+                {"role": "user", "content": user_content},
+            ],
+            max_completion_tokens=300,
+        )
     return res.choices[0].message.content
 
 
-def build_index(pdf_path: str) -> int:
-    
-    global CURRENT_PDF, all_docs, index
-
-    CURRENT_PDF = pdf_path
-    all_docs = []
+def _describe_or_none(image_bytes: bytes, timeout: float, retries: int) -> str | None:
+    # The gateway already retried transient errors; give up on this crop only.
+    try:
+        return describe_image(image_bytes, context=None, timeout=timeout, max_retries=retries)
+    except Exception as e:
+        print(f"[DESCRIBE_IMAGE] failed: {e}")
+        return None
+
+
+def describe_figures(
+    crops: list[bytes],
+    concurrency: int | None = None,
+    timeout: float | None = None,
+    retries: int | None = None,
+    on_progress: Callable[[int, int], None] | None = None,
+) -> list[str | None]:
+    """Describe all crops concurrently; results keep the input order.
+
+    Crops already seen (same PNG bytes, model and prompt version) are served
+    from the figure cache, and identical crops within one paper are sent
+    only once. A crop whose call still fails after all retries gets None,
+    so one bad figure does not fail the whole upload. on_progress(done, total)
+    is called as each upstream call finishes.
+    """
+    if not crops:
+        return []
+
+    concurrency = concurrency or FIGURE_CONCURRENCY
+    timeout = FIGURE_TIMEOUT_S if timeout is None else timeout
+    retries = FIGURE_RETRIES if retries is None else retries
+
+    keys = [figure_key(c, FIGURE_MODEL, FIGURE_PROMPT_VERSION) for c in crops]
+    results: dict[str, str | None] = {}
+    missing: dict[str, bytes] = {}
+    for key, crop in zip(keys, crops):
+        if key in results or key in missing:
+            continue
+        cached = load_figure(key)
+        if cached is not None:
+            results[key] = cached["description"]
+        else:
+            missing[key] = crop
+
+    print(f"[DESCRIBE_FIGURES] {len(crops)} crops, {len(results)} cached, {len(missing)} to describe")
+    metrics.record_cache("figure", hit=True, amount=len(results))
+    metrics.record_cache("figure", hit=False, amount=len(missing))
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(missing))) as pool:
+            futures = {
+                pool.submit(_describe_or_none, crop, timeout, retries): key
+                for key, crop in missing.items()
+            }
+            for done, fut in enumerate(as_completed(futures), start=1):
+                key, desc = futures[fut], fut.result()
+                results[key] = desc
+                if desc is not None:
+                    save_figure(key, desc)
+                if on_progress:
+                    on_progress(done, len(missing))
+
+    return [results[key] for key in keys]
+
+
+def build_index(
+    pdf_path: str,
+    doc_id: str | None = None,
+    content_hash: str | None = None,
+    progress: Callable[[str, float], None] | None = None,
+) -> int:
+    # progress(stage, percent) lets background jobs report where indexing is.
+    report = progress or (lambda stage, percent: None)
+
+    content_hash = content_hash or pdf_sha256(pdf_path)
+    doc_id = doc_id or content_hash
+
+    try:
+        doc = get_document(doc_id, load=False)
+        if doc["complete"]:
+            print(f"[BUILD_INDEX] {doc_id}: already in memory")
+            return len(doc["all_docs"])
+    except KeyError:
+        pass
+
+    cached = open_index(content_hash, embed_model=EMBED_MODEL_NAME)
+    if cached is not None and cached["backend"] != INDEX_BACKEND:
+        print(f"[BUILD_INDEX] {doc_id}: cached index is {cached['backend']}, rebuilding as {INDEX_BACKEND}")
+        cached = None
+    elif cached is not None and not cached["complete"]:
+        # Descriptions that succeeded last time come from the figure cache.
+        print(f"[BUILD_INDEX] {doc_id}: cached index is missing figure descriptions, rebuilding")
+        cached = None
+        # Answers given from the incomplete index may be wrong about figures.
+        answer_cache.invalidate(doc_id)
+    metrics.record_cache("index", hit=cached is not None)
+    if cached is not None:
+        register_document(doc_id, pdf_path, cached["all_docs"], cached["index"], mapped=cached["mapped"], refs=cached["refs"])
+        print(f"[BUILD_INDEX] {doc_id}: loaded from cache, docs in index: {len(cached['all_docs'])}")
+        return len(cached["all_docs"])
+
+    all_docs: list[dict] = []
+
+    if TEXT_EXTRACTOR == "pymupdf":
+        report("reading_pages", 5)
+        page_texts, crops = process_pdf(pdf_path, with_text=True)
+        with metrics.timed("text_fallback"):
+            page_texts = fill_empty_pages(pdf_path, page_texts)
+    else:
+        report("extracting_text", 5)
+        with metrics.timed("text_extraction"):
+            texts = _pdfplumber_page_texts(pdf_path)
+            page_texts = [texts[n] for n in sorted(texts)]
+        report("detecting_figures", 15)
+        crops = extract_figure_crops(pdf_path)
 
-   
-    full_text = extract_text_clean(pdf_path)
-    text_chunks = chunk_text(full_text)
+    full_text = clean_text(page_texts)
 
-    for c in text_chunks:
+    # Offsets let get_context merge neighbouring chunks instead of repeating the overlap.
+    for start, end in chunk_spans(full_text):
         all_docs.append(
             {
                 "type": "text",
-                "content": c,
+                "content": full_text[start:end],
+                "start": start,
+                "end": end,
             }
         )
 
-    pages = render_pages(pdf_path)
-    for p in pages:
-        boxes, img = detect_visual_blocks(p["image"])
-        for (x, y, w, h) in boxes:
-            crop = img[y : y + h, x : x + w]
-            _, buf = cv2.imencode(".png", crop)
-            crop_bytes = buf.tobytes()
+    report("describing_figures", 35)
+    descriptions = describe_figures(
+        [c for _, c in crops],
+        on_progress=lambda done, total: report("describing_figures", 35 + 50 * done / total),
+    )
+    # A failed call (None) is not a verdict on the crop; retried on the next build.
+    failed = sum(d is None for d in descriptions)
+    if failed:
+        print(f"[BUILD_INDEX] {failed} of {len(crops)} figure descriptions failed; index saved as incomplete")
+    for (page_no, _), fig_desc in zip(crops, descriptions):
+        if fig_desc is None or fig_desc.strip() == NOT_A_FIGURE:
+            continue
 
-            fig_desc = describe_image(crop_bytes, context=None)
-            
-            if fig_desc.strip() == "This image does not appear to be a scientific figure from the paper.":
-                continue
+        all_docs.append(
+            {
+                "type": "figure",
+                "content": fig_desc,
+                "page": page_no,
+            }
+        )
 
-            all_docs.append(
-                {
-                    "type": "figure",
-                    "content": fig_desc,
-                    "page": p["page"],
-                }
-            )
+    refs = build_refs(full_text, page_texts, all_docs)
+    print(f"[BUILD_INDEX] captions found: {', '.join(r['label'] for r in refs.values()) or 'none'}")
 
     texts_for_emb = [d["content"] for d in all_docs]
     if not texts_for_emb:
         raise ValueError("No text or figures extracted from PDF.")
 
-    embeddings = embed_model.encode(texts_for_emb, convert_to_numpy=True)
+    report("embedding", 85)
+    with metrics.timed("embedding"):
+        embeddings = get_embed_model().encode(texts_for_emb, batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True)
 
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(embeddings)
+    with metrics.timed("index_build"):
+        index, backend = build_vector_index(embeddings)
+    if backend != INDEX_BACKEND:
+        print(f"[BUILD_INDEX] {len(embeddings)} vectors are too few for {INDEX_BACKEND}, using {backend}")
 
-    print(f"[BUILD_INDEX] docs in index: {len(all_docs)}")
-    return len(all_docs)
+    report("saving", 95)
+    # Stored under the configured name, so a fallback is not rebuilt on every load.
+    save_index(
+        content_hash, all_docs, index,
+        refs=refs, backend=INDEX_BACKEND, complete=not failed, embed_model=EMBED_MODEL_NAME,
+    )
 
+    # Swap the heap copy for the memory-mapped one other workers also use.
+    mapped = False
+    reopened = open_index(content_hash, embed_model=EMBED_MODEL_NAME)
+    if reopened is not None and reopened["mapped"]:
+        all_docs, index, mapped = reopened["all_docs"], reopened["index"], True
+    register_document(doc_id, pdf_path, all_docs, index, mapped=mapped, refs=refs, complete=not failed)
+
+    print(f"[BUILD_INDEX] {doc_id}: docs in index: {len(all_docs)}")
+    return len(all_docs)
 
-def get_context(question: str, k: int = 5) -> str:
-    if index is None:
-        raise ValueError("PDF not processed yet (index is None)")
 
-    q_emb = embed_model.encode([question])
-    _, ids = index.search(q_emb, k)
+def _estimate_nbytes(all_docs: list[dict], index, mapped: bool = False) -> int:
+    # Memory-mapped vectors live in the shared page cache, not in our heap.
+    vectors = 0 if mapped else index_nbytes(index)
+    texts = sum(len(d["content"].encode("utf-8")) for d in all_docs)
+    return vectors + texts
+
+
+def register_document(
+    doc_id: str,
+    pdf_path: str | None,
+    all_docs: list[dict],
+    index,
+    mapped: bool = False,
+    refs: dict | None = None,
+    complete: bool = True,
+) -> dict:
+    entry = {
+        "doc_id": doc_id,
+        "pdf_path": pdf_path,
+        "all_docs": all_docs,
+        "index": index,
+        "mapped": mapped,
+        "refs": refs or {},
+        "complete": complete,
+        "nbytes": _estimate_nbytes(all_docs, index, mapped),
+    }
+    with _registry_lock:
+        replaced = _registry.pop(doc_id, None) is not None
+        _registry[doc_id] = entry
+        _evict_over_budget()
+    if replaced:
+        # Cached answers came from the index this one replaces.
+        dropped = answer_cache.invalidate(doc_id)
+        if dropped:
+            print(f"[REGISTRY] {doc_id} replaced, dropped {dropped} cached answers")
+    return entry
+
+
+def _evict_over_budget() -> None:
+    # Drop least recently used documents until we fit the budget, but
+    # always keep the newest one even if it alone exceeds it.
+    budget = INDEX_MEMORY_BUDGET_MB * 1024 * 1024
+    total = sum(e["nbytes"] for e in _registry.values())
+    while total > budget and len(_registry) > 1:
+        evicted_id, evicted = _registry.popitem(last=False)
+        total -= evicted["nbytes"]
+        print(f"[REGISTRY] evicted {evicted_id} ({evicted['nbytes']} bytes)")
+
+
+def get_document(doc_id: str | None, load: bool = True) -> dict:
+    """Return the registry entry for doc_id and mark it used.
+
+    On a miss the index is opened from the shared store (memory-mapped) when
+    load is True, so a paper indexed by another worker is served here too.
+    """
+    # No "latest upload" fallback: every request names its paper, so one
+    # user never gets answers about another user's upload.
+    with _registry_lock:
+        if doc_id is not None and doc_id in _registry:
+            _registry.move_to_end(doc_id)
+            return _registry[doc_id]
+
+    if load and doc_id is not None and is_store_key(doc_id):
+        stored = open_index(doc_id, embed_model=EMBED_MODEL_NAME)
+        if stored is not None:
+            print(f"[REGISTRY] opened {doc_id} from the shared store (mmap={stored['mapped']})")
+            return register_document(
+                doc_id, None, stored["all_docs"], stored["index"],
+                mapped=stored["mapped"], refs=stored["refs"], complete=stored["complete"],
+            )
 
-    parts = [all_docs[i]["content"] for i in ids[0]]
-    context = "\n\n---\n\n".join(parts)
+    raise KeyError(f"Document not indexed: {doc_id}")
+
+
+def has_document(doc_id: str) -> bool:
+    try:
+        get_document(doc_id)
+        return True
+    except KeyError:
+        return False
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _mmr_order(index, ids: list[int], q_emb: np.ndarray) -> list[int]:
+    """Order candidate ids by maximal marginal relevance.
+
+    Falls back to the search order when the index cannot return stored
+    vectors (some compressed FAISS indexes do not support reconstruct).
+    """
+    try:
+        vectors = np.vstack([index.reconstruct(int(i)) for i in ids]).astype(np.float32)
+    except Exception:
+        return ids
+
+    vectors = _unit_rows(vectors)
+    relevance = vectors @ _unit_rows(np.asarray(q_emb, dtype=np.float32).reshape(1, -1))[0]
+    similarity = vectors @ vectors.T
+
+    order, remaining = [], list(range(len(ids)))
+    while remaining:
+        if order:
+            redundancy = similarity[np.ix_(remaining, order)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining))
+        scores = CONTEXT_MMR_LAMBDA * relevance[remaining] - (1 - CONTEXT_MMR_LAMBDA) * redundancy
+        order.append(remaining.pop(int(np.argmax(scores))))
+    return [ids[i] for i in order]
+
+
+def _new_chars(span: tuple[int, int], taken: list[tuple[int, int]]) -> int:
+    # Characters of span not already covered by chunks picked before it.
+    start, end = span
+    covered = sum(max(0, min(end, e) - max(start, s)) for s, e in taken)
+    return max(0, end - start - covered)
+
+
+def _merge_text_chunks(ranked_docs: list[tuple[int, dict]]) -> list[tuple[int, str]]:
+    """Merge overlapping/adjacent (rank, text doc) pairs into (best rank, text) passages."""
+    runs: list[list] = []  # [best rank, start, end, text]
+    for rank, d in sorted(ranked_docs, key=lambda rd: rd[1]["start"]):
+        if runs and d["start"] <= runs[-1][2]:
+            run = runs[-1]
+            run[0] = min(run[0], rank)
+            if d["end"] > run[2]:
+                run[3] += d["content"][run[2] - d["start"]:]
+                run[2] = d["end"]
+        else:
+            runs.append([rank, d["start"], d["end"], d["content"]])
+    return [(rank, text) for rank, _, _, text in runs]
+
+
+def pack_context(all_docs: list[dict], ranked_ids: list[int], token_budget: int | None = None, max_docs: int | None = None) -> str:
+    """Pack docs in ranked order up to token_budget, merging neighbouring text chunks.
+
+    The first doc is always included, even if it alone exceeds the budget.
+    Merged passages take the rank of their best chunk.
+    """
+    budget_chars = (CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget) * CHARS_PER_TOKEN
+    picked, taken, used = [], [], 0
+
+    for i in ranked_ids:
+        d = all_docs[i]
+        # Text chunks only cost what they add beyond overlaps with picked neighbours.
+        cost = _new_chars((d["start"], d["end"]), taken) if "start" in d else len(d["content"])
+        if picked and used + cost > budget_chars:
+            continue
+        picked.append(d)
+        used += cost
+        if "start" in d:
+            taken.append((d["start"], d["end"]))
+        if max_docs is not None and len(picked) >= max_docs:
+            break
+
+    blocks = _merge_text_chunks([(r, d) for r, d in enumerate(picked) if "start" in d])
+    blocks += [(r, d["content"]) for r, d in enumerate(picked) if "start" not in d]
+    blocks.sort(key=lambda b: b[0])
+    return "\n\n---\n\n".join(text for _, text in blocks)
+
+
+def reference_context(doc: dict, question: str, token_budget: int | None = None) -> str | None:
+    """Context for questions naming a figure/table the paper has a caption for, else None.
+
+    A dict lookup in the document's refs: the caption, the figure
+    descriptions from its page and the text chunk around the caption.
+    """
+    found = [doc["refs"][key] for key in question_refs(question) if key in doc["refs"]]
+    if not found:
+        return None
+
+    lines = []
+    for ref in found:
+        where = f" (page {ref['page']})" if ref["page"] else ""
+        lines.append(f"{ref['label']}{where} caption: {ref['caption']}")
+    captions = "\n".join(lines)
+    budget = (CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget) - len(captions) // CHARS_PER_TOKEN
+    ids = list(dict.fromkeys(i for ref in found for i in ref["doc_ids"]))
+    # Figure descriptions first: they are what "what is in Figure N" asks about.
+    ids.sort(key=lambda i: doc["all_docs"][i]["type"] != "figure")
+    packed = pack_context(doc["all_docs"], ids, max(budget, 0)) if ids else ""
+    return f"{captions}\n\n---\n\n{packed}" if packed else captions
+
+
+def get_context(question: str, k: int = 5, doc_id: str | None = None, q_emb=None, token_budget: int | None = None) -> str:
+    """Relevant passages for question, deduplicated and packed into token_budget.
+
+    Questions naming a known figure/table are answered from the reference
+    index (reference_context) without an embedding search. Otherwise k is the
+    most chunks that are packed; CONTEXT_CANDIDATES neighbours are searched
+    and re-ranked with MMR so near-duplicate chunks do not crowd out other
+    relevant ones.
+    """
+    try:
+        doc = get_document(doc_id)
+    except KeyError:
+        raise ValueError("PDF not processed yet (no index for this document)")
+
+    context = reference_context(doc, question, token_budget)
+    metrics.inc("chatbot_context_source_total", source="reference" if context is not None else "search")
+    if context is not None:
+        return context
+
+    if q_emb is None:
+        with metrics.timed("query_embedding"):
+            q_emb = get_embed_model().encode([question])
+    index = doc["index"]
+    with metrics.timed("faiss_search"):
+        _, ids = search_index(index, q_emb, max(k, CONTEXT_CANDIDATES))
+
+    with metrics.timed("context_packing"):
+        candidates = [int(i) for i in ids[0] if i != -1]
+        ranked = _mmr_order(index, candidates, q_emb)
+        context = pack_context(doc["all_docs"], ranked, token_budget, max_docs=k)
+
+    metrics.observe("chatbot_context_tokens", len(context) / CHARS_PER_TOKEN, buckets=metrics.TOKEN_BUCKETS)
     return context
 
 
@@ -241,10 +649,29 @@ Otherwise:
 
 
 
-def ask_llm(question: str, context: str | None = None) -> str:
+ANSWER_MODEL = "gpt-4o-mini"
+
+EMPTY_ANSWER = "The model returned an empty answer. Please try asking again or check that the uploaded paper contains relevant text."
+
+
+def _build_messages(
+    question: str,
+    context: str | None = None,
+    doc_id: str | None = None,
+    q_emb=None,
+    session: dict | None = None,
+) -> list[dict]:
+    # Layout: SYSTEM_PROMPT, session summary, past turns, then this turn's
+    # context and question. Everything before the last message is identical
+    # to the previous request's prefix, so it can hit the provider prompt cache.
     if context is None:
+        query = question
+        if session and session["turns"]:
+            # Follow-ups like "explain more" retrieve poorly on their own.
+            query = f"{session['turns'][-1]['question']}\n{question}"
+            q_emb = None
         try:
-            context = get_context(question, k=5) if index is not None else None
+            context = get_context(query, k=5, doc_id=doc_id, q_emb=q_emb)
         except Exception:
             print("[ASK_LLM] get_context ERROR")
             context = None
@@ -260,19 +687,101 @@ def ask_llm(question: str, context: str | None = None) -> str:
     else:
         user_content = question
 
-    res = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_content},
-        ],
-        max_completion_tokens=400,
-    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *sessions.history_messages(session),
+        {"role": "user", "content": user_content},
+    ]
+
+
+def _check_answer_cache(question: str, context: str | None, doc_id: str | None, session: dict | None = None):
+    """Return (cached_answer, cache_doc_id, q_emb).
+
+    Only retrieval-backed questions are cached; with an explicit context, or
+    in a session that already has turns (the answer depends on them),
+    cache_doc_id is None and nothing is looked up or stored.
+    """
+    if context is not None or (session and session["turns"]):
+        return None, None, None
+    try:
+        cache_doc_id = get_document(doc_id)["doc_id"]
+    except KeyError:
+        return None, None, None
+
+    with metrics.timed("query_embedding"):
+        q_emb = get_embed_model().encode([question])
+    cached = answer_cache.lookup(cache_doc_id, question, q_emb[0])
+    metrics.record_cache("answer", hit=cached is not None)
+    return cached, cache_doc_id, q_emb
+
+
+def ask_llm(question: str, context: str | None = None, doc_id: str | None = None, session: dict | None = None) -> str:
+    """Answer a question about doc_id; with a session, prior turns are part of the prompt and this turn is recorded."""
+    cached, cache_doc_id, q_emb = _check_answer_cache(question, context, doc_id, session)
+    if cached is not None:
+        print("[ASK_LLM] answer cache hit")
+        if session is not None:
+            sessions.record_turn(session, question, cached)
+        return cached
+
+    messages = _build_messages(question, context, cache_doc_id or doc_id, q_emb, session)
+    with metrics.timed("llm_call"):
+        res = llm_gateway.chat(
+            model=ANSWER_MODEL,
+            messages=messages,
+            max_completion_tokens=400,
+        )
 
     content = res.choices[0].message.content
     print("[ASK_LLM] RAW CONTENT PREVIEW:", repr(content)[:200])
 
     if content is None or not str(content).strip():
-        return "The model returned an empty answer. Please try asking again or check that the uploaded paper contains relevant text."
+        return EMPTY_ANSWER
 
+    if cache_doc_id:
+        answer_cache.store(cache_doc_id, question, content.strip(), q_emb[0])
+    if session is not None:
+        sessions.record_turn(session, question, content.strip())
     return content.strip()
+
+
+def ask_llm_stream(question: str, context: str | None = None, doc_id: str | None = None, session: dict | None = None):
+    """Like ask_llm, but yields the answer text piece by piece as the model produces it."""
+    cached, cache_doc_id, q_emb = _check_answer_cache(question, context, doc_id, session)
+    if cached is not None:
+        print("[ASK_LLM] answer cache hit")
+        yield cached
+        if session is not None:
+            sessions.record_turn(session, question, cached)
+        return
+
+    messages = _build_messages(question, context, cache_doc_id or doc_id, q_emb, session)
+    start = time.perf_counter()
+    stream = llm_gateway.chat_stream(
+        model=ANSWER_MODEL,
+        messages=messages,
+        max_completion_tokens=400,
+        stream_options={"include_usage": True},
+    )
+
+    pieces = []
+    for chunk in stream:
+        # With include_usage the last chunk has no choices, only usage.
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if not pieces:
+                metrics.observe("chatbot_stage_seconds", time.perf_counter() - start, stage="llm_first_token")
+            pieces.append(delta)
+            yield delta
+    metrics.observe("chatbot_stage_seconds", time.perf_counter() - start, stage="llm_call")
+
+    answer = "".join(pieces).strip()
+    if not answer:
+        yield EMPTY_ANSWER
+        return
+    if cache_doc_id:
+        answer_cache.store(cache_doc_id, question, answer, q_emb[0])
+    if session is not None:
+        sessions.record_turn(session, question, answer)
@@ -0,0 +1,68 @@
+# prebuild_indexes.py
+# Ingestion stage: build the chatbot index of every stored paper once, right
+# after Automation_pdf_download_script.py has put its PDF in the bucket, so
+# "Discuss with AI" opens catalog papers without an upload or a wait.
+#
+#   python prebuild_indexes.py            # papers without an index yet
+#   python prebuild_indexes.py --limit 20
+#
+# Point INDEX_CACHE_DIR at the store the API workers use. Indexes land under
+# their PDF hash like uploaded ones, and paper_store records paper_id -> hash.
+import os, time, argparse, tempfile
+
+import pipeline
+from index_store import pdf_sha256, has_current_index
+from paper_store import get_supabase, fetch_stored_papers, download_pdf, paper_hash, save_paper_hash
+
+
+def _needs_index(paper_id: str) -> bool:
+    content_hash = paper_hash(paper_id)
+    # Missing, outdated (version, model, backend) or incomplete indexes are rebuilt.
+    return content_hash is None or not has_current_index(
+        content_hash, pipeline.EMBED_MODEL_NAME, pipeline.INDEX_BACKEND
+    )
+
+
+def prebuild(limit: int | None = None) -> int:
+    """Build indexes for stored papers that have none; returns how many were built."""
+    supa = get_supabase()
+    todo = [p for p in fetch_stored_papers(supa) if _needs_index(str(p["id"]))]
+    if limit is not None:
+        todo = todo[:limit]
+    print(f"[PREBUILD] {len(todo)} papers to index")
+
+    pipeline.warm_up()
+    built = 0
+    for paper in todo:
+        paper_id = str(paper["id"])
+        started = time.perf_counter()
+        try:
+            pdf_bytes = download_pdf(supa, paper["stored_pdf_path"])
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+                f.write(pdf_bytes)
+            try:
+                content_hash = pdf_sha256(f.name)
+                num_docs = pipeline.build_index(f.name, content_hash=content_hash)
+            finally:
+                os.remove(f.name)
+        except Exception as e:
+            print(f"[PREBUILD] {paper_id}: failed, will retry next run: {e}")
+            continue
+
+        save_paper_hash(paper_id, content_hash, paper["stored_pdf_path"])
+        built += 1
+        print(f"[PREBUILD] {paper_id}: {num_docs} docs in {time.perf_counter() - started:.1f}s")
+
+    print(f"[PREBUILD] built {built} of {len(todo)} indexes")
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build chatbot indexes for papers in storage.")
+    parser.add_argument("--limit", type=int, help="at most this many papers in this run")
+    args = parser.parse_args()
+    prebuild(limit=args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# references.py
+# Lexical index of figure/table captions, so questions such as "what is in
+# Fig. 6" are answered from the caption and the matching figure description
+# instead of an embedding search (MiniLM matches figure numbers poorly).
+import re
+
+
+# "Figure 6: ...", "Fig. 6. ...", "TABLE 2 | ..." in the paper text.
+CAPTION_RE = re.compile(r"\b(fig(?:ure)?\.?|table)\s*(\d{1,3})\s*([:.|])\s+", re.IGNORECASE)
+# "figure 6", "Fig 6", "figs. 3", "table 2" in a question.
+QUESTION_REF_RE = re.compile(r"\b(fig(?:ure)?s?\.?|tables?)\s*(\d{1,3})\b", re.IGNORECASE)
+
+# In-text mentions ("as shown in Figure 6.") look like period-style captions.
+MENTION_WORDS = {"in", "see", "of", "and", "to", "from", "by", "on", "with", "cf", "as", "than"}
+CAPTION_MAX_CHARS = 400
+
+
+def ref_key(kind: str, number: str | int) -> str:
+    """'Fig.' / 'figures' / 'TABLE' + 6 -> 'figure:6' / 'table:6'."""
+    return f"{'table' if kind.lower().startswith('tab') else 'figure'}:{int(number)}"
+
+
+def _caption_text(text: str, start: int, end: int) -> str:
+    rest = text[end:end + CAPTION_MAX_CHARS]
+    # Stop at the next caption, e.g. two figures side by side.
+    nxt = CAPTION_RE.search(rest)
+    if nxt:
+        rest = rest[:nxt.start()]
+    # End at the first sentence break after a short minimum.
+    stop = re.search(r"(?<=.{40})[.!?](\s|$)", rest)
+    if stop:
+        rest = rest[:stop.start() + 1]
+    return (text[start:end] + rest).strip()
+
+
+def find_captions(text: str) -> dict[str, tuple[int, str]]:
+    """ref key -> (offset, caption) for the most caption-like occurrence of each label.
+
+    A colon/bar after the number wins over a period, and period matches
+    preceded by words like "in" or "see" are treated as mentions.
+    """
+    found: dict[str, tuple[int, int, str]] = {}
+    for m in CAPTION_RE.finditer(text):
+        key = ref_key(m.group(1), m.group(2))
+        if m.group(3) == ".":
+            before = text[max(0, m.start() - 12):m.start()].split()
+            if before and before[-1].lower().strip("(.,") in MENTION_WORDS:
+                continue
+            strength = 1
+        else:
+            strength = 2
+        if key not in found or strength > found[key][0]:
+            found[key] = (strength, m.start(), _caption_text(text, m.start(), m.end()))
+    return {key: (offset, caption) for key, (_, offset, caption) in found.items()}
+
+
+def build_refs(full_text: str, page_texts: list[str] | None, all_docs: list[dict]) -> dict[str, dict]:
+    """ref key -> { "label", "caption", "page", "doc_ids" } for every caption in the paper.
+
+    doc_ids point into all_docs: the text chunk holding the caption and the
+    figure descriptions cropped from the caption's page.
+    """
+    refs: dict[str, dict] = {}
+    pages: dict[str, int] = {}
+    for page_no, page_text in enumerate(page_texts or [], start=1):
+        for key in find_captions(page_text):
+            pages.setdefault(key, page_no)
+
+    for key, (offset, caption) in find_captions(full_text).items():
+        page = pages.get(key)
+        doc_ids = [
+            i for i, d in enumerate(all_docs)
+            if (d["type"] == "text" and d["start"] <= offset < d["end"])
+            or (d["type"] == "figure" and page is not None and d.get("page") == page)
+        ]
+        kind, number = key.split(":")
+        refs[key] = {
+            "label": f"{kind.capitalize()} {number}",
+            "caption": caption,
+            "page": page,
+            "doc_ids": doc_ids,
+        }
+    return refs
+
+
+def question_refs(question: str) -> list[str]:
+    """Ref keys mentioned in a question, in order, without duplicates."""
+    keys = [ref_key(kind, number) for kind, number in QUESTION_REF_RE.findall(question)]
+    return list(dict.fromkeys(keys))
@@ -0,0 +1,201 @@
+# sessions.py
+# Server-side conversation sessions for /ask. The last SESSION_HISTORY_TURNS
+# turns are replayed verbatim; older ones are folded, SESSION_SUMMARY_BATCH
+# at a time, into a running summary. Sessions live in the shared store so
+# any worker can continue a conversation.
+#
+# Summaries are written off the request path: a background thread stores
+# the new summary next to the session, and the next request that loads the
+# session folds it in.
+import os, re, json, time, uuid, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_gateway
+from index_store import INDEX_CACHE_DIR
+
+
+SESSION_HISTORY_TURNS = int(os.getenv("SESSION_HISTORY_TURNS", "6"))
+SESSION_SUMMARY_BATCH = int(os.getenv("SESSION_SUMMARY_BATCH", "4"))
+SESSION_TTL_S = int(os.getenv("SESSION_TTL_S", str(24 * 3600)))
+SUMMARY_MODEL = "gpt-4o-mini"
+
+SESSIONS_DIR = os.path.join(INDEX_CACHE_DIR, "sessions")
+os.makedirs(SESSIONS_DIR, exist_ok=True)
+
+_last_prune = 0.0
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-summary")
+# Session ids with a summary being computed in this process.
+_summarizing: set[str] = set()
+_summarizing_lock = threading.Lock()
+
+
+def _path(session_id: str) -> str:
+    return os.path.join(SESSIONS_DIR, f"{session_id}.json")
+
+
+def _summary_path(session_id: str) -> str:
+    # { "base", "questions", "summary" }: summary extends base and replaces the
+    # turns with these questions, if the session still starts with them.
+    return os.path.join(SESSIONS_DIR, f"{session_id}.summary")
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _save(session: dict) -> None:
+    _write_json(_path(session["session_id"]), session)
+
+
+def _fold_summary(session: dict) -> None:
+    try:
+        with open(_summary_path(session["session_id"]), "r", encoding="utf-8") as f:
+            pending = json.load(f)
+    except (OSError, ValueError):
+        return
+    n = len(pending["questions"])
+    if session["summary"] == pending["base"] and [t["question"] for t in session["turns"][:n]] == pending["questions"]:
+        session["summary"] = pending["summary"]
+        session["turns"] = session["turns"][n:]
+        _save(session)
+    try:
+        os.remove(_summary_path(session["session_id"]))
+    except OSError:
+        pass
+
+
+def load_session(session_id: str) -> dict | None:
+    if not re.fullmatch(r"[0-9a-f]{32}", session_id or ""):
+        return None
+    try:
+        with open(_path(session_id), "r", encoding="utf-8") as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if session["updated_at"] < time.time() - SESSION_TTL_S:
+        return None
+    _fold_summary(session)
+    return session
+
+
+def _prune_expired() -> None:
+    # At most once per SESSION_TTL_S / 24 in this process.
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < SESSION_TTL_S / 24:
+        return
+    _last_prune = now
+    for name in os.listdir(SESSIONS_DIR):
+        # Also removes .summary files of expired sessions.
+        path = os.path.join(SESSIONS_DIR, name)
+        try:
+            if os.path.getmtime(path) < now - SESSION_TTL_S:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def get_or_create(session_id: str | None, doc_id: str | None) -> dict:
+    """The session to continue, or a new one if the id is unknown, expired or for another paper."""
+    session = load_session(session_id) if session_id else None
+    if session is not None and session["doc_id"] == doc_id:
+        return session
+
+    now = time.time()
+    session = {
+        "session_id": uuid.uuid4().hex,
+        "doc_id": doc_id,
+        "summary": "",
+        "turns": [],
+        "created_at": now,
+        "updated_at": now,
+    }
+    _prune_expired()
+    _save(session)
+    return session
+
+
+def history_messages(session: dict | None) -> list[dict]:
+    """Summary and recent turns as chat messages, oldest first.
+
+    Only questions and answers are replayed, never the retrieved context, and
+    the list only grows between summaries, so successive requests share a
+    long identical prefix that the provider can serve from its prompt cache.
+    """
+    if not session:
+        return []
+    messages = []
+    if session["summary"]:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{session['summary']}"})
+    for turn in session["turns"]:
+        messages.append({"role": "user", "content": turn["question"]})
+        messages.append({"role": "assistant", "content": turn["answer"]})
+    return messages
+
+
+def _summarize(summary: str, turns: list[dict]) -> str:
+    transcript = "\n\n".join(f"User: {t['question']}\nAssistant: {t['answer']}" for t in turns)
+    res = llm_gateway.chat(
+        model=SUMMARY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You maintain a running summary of a conversation about a scientific paper. "
+                    "Keep which figures, tables, sections and concepts were discussed and what was "
+                    "concluded, in at most 150 words."
+                ),
+            },
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+        ],
+        max_completion_tokens=300,
+    )
+    return (res.choices[0].message.content or "").strip()
+
+
+def _summarize_in_background(session_id: str, base: str, batch: list[dict]) -> None:
+    try:
+        summary = _summarize(base, batch)
+        _write_json(
+            _summary_path(session_id),
+            {"base": base, "questions": [t["question"] for t in batch], "summary": summary},
+        )
+    except Exception as e:
+        # The next turn tries again; record_turn bounds the history meanwhile.
+        print(f"[SESSIONS] summary failed for {session_id}: {e}")
+    finally:
+        with _summarizing_lock:
+            _summarizing.discard(session_id)
+
+
+def record_turn(session: dict, question: str, answer: str) -> None:
+    """Append a turn; once the window overflows by a full batch, summarize the oldest batch.
+
+    Summarizing in batches keeps the replayed prefix unchanged for several
+    turns in a row instead of shifting it on every question. The summary
+    call runs in the background, so the answer is never delayed by it.
+    """
+    session["turns"].append({"question": question, "answer": answer})
+    session["updated_at"] = time.time()
+
+    overflow = len(session["turns"]) - SESSION_HISTORY_TURNS
+    if overflow >= 2 * SESSION_SUMMARY_BATCH:
+        # Summaries keep failing; drop the oldest turns unsummarized to keep the prompt bounded.
+        session["turns"] = session["turns"][SESSION_SUMMARY_BATCH:]
+    elif overflow >= SESSION_SUMMARY_BATCH:
+        with _summarizing_lock:
+            start = session["session_id"] not in _summarizing
+            _summarizing.add(session["session_id"])
+        if start:
+            _summary_executor.submit(
+                _summarize_in_background,
+                session["session_id"],
+                session["summary"],
+                [dict(t) for t in session["turns"][:SESSION_SUMMARY_BATCH]],
+            )
+
+    _save(session)
@@ -0,0 +1,135 @@
+# upload_store.py
+# Content-addressed storage for uploaded PDFs: uploads/<sha256>.pdf.
+# Uploads are copied in chunks while hashing, capped at MAX_UPLOAD_MB, stored
+# once per distinct file, and old files are removed by age and total size.
+import os, time, uuid, hashlib, threading
+from typing import Callable
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "50"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Garbage collection: files untouched for UPLOAD_TTL_S are removed, then the
+# least recently uploaded ones until the directory fits in UPLOAD_QUOTA_MB.
+UPLOAD_TTL_S = int(os.getenv("UPLOAD_TTL_S", str(7 * 24 * 3600)))
+UPLOAD_QUOTA_MB = int(os.getenv("UPLOAD_QUOTA_MB", "2048"))
+UPLOAD_GC_INTERVAL_S = int(os.getenv("UPLOAD_GC_INTERVAL_S", "300"))
+
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+_last_gc = 0.0
+_gc_lock = threading.Lock()
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def upload_path(content_hash: str) -> str:
+    return os.path.join(UPLOAD_DIR, f"{content_hash}.pdf")
+
+
+def _finish(tmp_path: str, content_hash: str) -> str:
+    path = upload_path(content_hash)
+    if os.path.exists(path):
+        # Same bytes already stored; keep the old copy and mark it as fresh.
+        os.remove(tmp_path)
+        os.utime(path)
+    else:
+        os.replace(tmp_path, path)
+    return path
+
+
+async def save_upload(file: UploadFile) -> tuple[str, str, int]:
+    """Copy an upload to UPLOAD_DIR in chunks; return (path, sha256, size).
+
+    Raises UploadTooLarge as soon as more than MAX_UPLOAD_MB has been read.
+    """
+    limit = MAX_UPLOAD_MB * 1024 * 1024
+    digest = hashlib.sha256()
+    size = 0
+
+    tmp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4().hex}.part")
+    out = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limit:
+                raise UploadTooLarge(f"Upload exceeds {MAX_UPLOAD_MB} MB.")
+            digest.update(chunk)
+            await run_in_threadpool(out.write, chunk)
+    except BaseException:
+        out.close()
+        os.remove(tmp_path)
+        raise
+    out.close()
+
+    content_hash = digest.hexdigest()
+    path = await run_in_threadpool(_finish, tmp_path, content_hash)
+    return path, content_hash, size
+
+
+def save_pdf_bytes(data: bytes) -> tuple[str, str]:
+    """Store a PDF already in memory (e.g. fetched from paper storage); return (path, sha256)."""
+    content_hash = hashlib.sha256(data).hexdigest()
+    tmp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4().hex}.part")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    return _finish(tmp_path, content_hash), content_hash
+
+
+def gc_uploads(in_use: Callable[[str], bool] | None = None) -> int:
+    """Remove expired uploads, then the oldest ones over quota; return how many were removed.
+
+    in_use(content_hash) protects files that an indexing job still needs.
+    """
+    now = time.time()
+    files = []
+    for name in os.listdir(UPLOAD_DIR):
+        path = os.path.join(UPLOAD_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, name, path))
+
+    removed = 0
+    total = sum(f[1] for f in files)
+    quota = UPLOAD_QUOTA_MB * 1024 * 1024
+
+    for mtime, size, name, path in sorted(files):
+        expired = mtime < now - UPLOAD_TTL_S
+        if not expired and total <= quota:
+            break
+        if in_use and name.endswith(".pdf") and in_use(name[:-4]):
+            continue
+        # Partial files are only ever removed once expired (they may be mid-copy).
+        if name.endswith(".part") and not expired:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+
+    if removed:
+        print(f"[UPLOAD_GC] removed {removed} files, {total / 1e6:.1f} MB left")
+    return removed
+
+
+def maybe_gc_uploads(in_use: Callable[[str], bool] | None = None) -> None:
+    """Run gc_uploads at most once per UPLOAD_GC_INTERVAL_S in this process."""
+    global _last_gc
+    with _gc_lock:
+        if time.time() - _last_gc < UPLOAD_GC_INTERVAL_S:
+            return
+        _last_gc = time.time()
+    gc_uploads(in_use)
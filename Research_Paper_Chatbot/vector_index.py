@@ -0,0 +1,108 @@
+# vector_index.py
+# FAISS index construction for build_index. INDEX_BACKEND picks the trade-off:
+#   flat  exact L2 over float32 (the original index)
+#   ip    exact inner product over normalized vectors (cosine)
+#   hnsw  HNSW graph, cosine; fastest search on large documents
+#   ivf   inverted lists, cosine; falls back to ip below IVF_MIN_POINTS_PER_LIST * nlist vectors
+#   sq8   int8 scalar quantization, cosine; 4x smaller than float32
+# There is deliberately no product quantization backend: recall@5 was ~0.08 on
+# 12k benchmark vectors at 16 subquantizers (0.37 even at 96), and a refine
+# stage to recover it would keep sq8 codes anyway. Use sq8 to save memory.
+import os, math
+
+import numpy as np
+import faiss
+
+
+INDEX_BACKEND = os.getenv("INDEX_BACKEND", "flat")
+BACKENDS = ("flat", "ip", "hnsw", "ivf", "sq8")
+
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+IVF_MIN_POINTS_PER_LIST = 39  # FAISS warns when k-means gets fewer
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).copy()
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _ivf_nlist(n: int) -> int:
+    return max(1, int(math.sqrt(n)))
+
+
+def resolve_backend(backend: str, n: int, d: int) -> str:
+    """The backend actually used for n vectors of dimension d (trained ones need enough data)."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown INDEX_BACKEND {backend!r}; expected one of {', '.join(BACKENDS)}")
+    if backend == "ivf" and n < IVF_MIN_POINTS_PER_LIST * _ivf_nlist(n):
+        return "ip"
+    return backend
+
+
+def build_vector_index(embeddings: np.ndarray, backend: str | None = None):
+    """Build and fill a FAISS index over embeddings; returns (index, backend used)."""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n, d = embeddings.shape
+    backend = resolve_backend(backend or INDEX_BACKEND, n, d)
+
+    if backend == "flat":
+        index = faiss.IndexFlatL2(d)
+        index.add(embeddings)
+        return index, backend
+
+    vectors = normalize(embeddings)
+    ip = faiss.METRIC_INNER_PRODUCT
+
+    if backend == "ip":
+        index = faiss.IndexFlatIP(d)
+    elif backend == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M, ip)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif backend == "ivf":
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFFlat(quantizer, d, _ivf_nlist(n), ip)
+        index.train(vectors)
+        index.nprobe = IVF_NPROBE
+        # get_context reconstructs candidate vectors for MMR.
+        index.make_direct_map()
+    else:
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, ip)
+        index.train(vectors)
+
+    index.add(vectors)
+    return index, backend
+
+
+def search(index, q_emb, k: int):
+    """index.search with the query normalized for cosine indexes and runtime knobs applied."""
+    q = np.asarray(q_emb, dtype=np.float32)
+    if q.shape[-1] != index.d:
+        # e.g. a query from a different embedding model than the index
+        raise ValueError(f"Query has dimension {q.shape[-1]}, index expects {index.d}")
+    q = np.ascontiguousarray(q.reshape(-1, index.d))
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        q = normalize(q)
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = IVF_NPROBE
+    elif isinstance(faiss.downcast_index(index), faiss.IndexHNSW):
+        faiss.downcast_index(index).hnsw.efSearch = HNSW_EF_SEARCH
+    return index.search(q, k)
+
+
+def index_nbytes(index) -> int:
+    """Rough heap size of the stored vectors (codes plus graph links for HNSW)."""
+    inner = faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return index.ntotal * (faiss.downcast_index(inner.storage).code_size + HNSW_M * 2 * 4)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return index.ntotal * (ivf.code_size + 8)
+    return index.ntotal * getattr(inner, "code_size", index.d * 4)
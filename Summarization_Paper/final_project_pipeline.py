@@ -11,59 +11,74 @@ Original file is located at
 
 # Extracts text from XML papers (converted locally via GROBID)
 # and generates structured summaries using the BART-Large-CNN model.
+#
+#   python final_project_pipeline.py xml_dir/ --out-dir summaries/
+#   python final_project_pipeline.py manifest.txt      # one XML path per line
+#   python final_project_pipeline.py 2601.04110v1.xml
+#
+# The model is loaded once per run. XML files are parsed in a process pool
+# while the model summarizes the papers parsed before them.
+import os
+import re
+import json
+import time
+import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
 
-xml_path = Path("/content/2601.04110v1.xml")
-JSON_output_path= xml_path.with_suffix(".json")
-txt_output_path = xml_path.with_name(xml_path.stem + "_summary.txt")
-pipeline4_output_path = xml_path.with_name(
-    xml_path.stem + "_with_figures.txt"
-)
+# Chunks per forward pass; larger batches keep the CPU matrix kernels busy.
+SUMMARY_BATCH_SIZE = 8
+# Papers summarized together, so short papers still fill whole batches.
+PAPERS_PER_STEP = 4
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
 
-with open(xml_path, "r", encoding="utf-8") as f:
-    xml_content = f.read()
+def parse_paper(xml_path):
+    xml_path = Path(xml_path)
+    with open(xml_path, "r", encoding="utf-8") as f:
+        xml_content = f.read()
 
-soup = BeautifulSoup(xml_content, "xml")
+    soup = BeautifulSoup(xml_content, "xml")
 
-# Title
-title_tag = soup.find("titleStmt")
-title = title_tag.find("title").get_text(strip=True) if title_tag else "N/A"
+    # Title
+    title_tag = soup.find("titleStmt")
+    title = title_tag.find("title").get_text(strip=True) if title_tag else "N/A"
 
-# Authors
-authors = []
-for author in soup.find_all("author"):
-    pers = author.find("persName")
-    if pers:
-        authors.append(pers.get_text(" ", strip=True))
+    # Authors
+    authors = []
+    for author in soup.find_all("author"):
+        pers = author.find("persName")
+        if pers:
+            authors.append(pers.get_text(" ", strip=True))
 
-authors_text = ", ".join(authors) if authors else "N/A"
+    # Date
+    date_tag = soup.find("date")
+    date = date_tag.get_text(strip=True) if date_tag else "N/A"
 
-# Date
-date_tag = soup.find("date")
-date = date_tag.get_text(strip=True) if date_tag else "N/A"
+    abstract = soup.find("abstract")
+    abstract_text = abstract.get_text(" ", strip=True) if abstract else ""
 
-print("Title:", title)
-print("Authors:", authors_text)
-print("Date:", date)
+    body = soup.find("body")
+    body_text = body.get_text(" ", strip=True) if body else ""
 
-abstract = soup.find("abstract")
-abstract_text = abstract.get_text(" ", strip=True) if abstract else ""
+    full_text = abstract_text + "\n\n" + body_text
 
-body = soup.find("body")
-body_text = body.get_text(" ", strip=True) if body else ""
+    return {
+        "xml_path": xml_path,
+        "title": title,
+        "authors": authors,
+        "date": date,
+        "chunks": chunk_text(clean_text(full_text)),
+    }
 
-full_text = abstract_text + "\n\n" + body_text
-len(full_text)
 
-import re
 # Clean extracted text by removing extra spaces and citation references
 def clean_text(text):
     text = re.sub(r"\s+", " ", text)
     text = re.sub(r"\[[0-9,\s]+\]", "", text)
     return text.strip()
 
-cleaned_text = clean_text(full_text)
 
 # Split long text into chunks suitable for BART-Large-CNN input limits
 def chunk_text(text, max_words=450):
@@ -75,30 +90,46 @@ def chunk_text(text, max_words=450):
             chunks.append(chunk)
     return chunks
 
-chunks = chunk_text(cleaned_text)
-len(chunks)
-
-from transformers import pipeline
-# Initialize BART-Large-CNN summarization model
-summarizer = pipeline(
-    "summarization",
-    model="facebook/bart-large-cnn",
-    device=-1
-)
-# Generate summaries for each text chunk
-raw_summaries = []
-
-for i, chunk in enumerate(chunks):
-    s = summarizer(
-        chunk,
-        max_length=150,
-        min_length=60,
-        do_sample=False
-    )
-    raw_summaries.append(s[0]["summary_text"])
-    print(f"✅ Chunk {i+1} summarized")
 
-raw_summary = " ".join(raw_summaries)
+summarizer = None
+
+
+# Initialize BART-Large-CNN summarization model (once per process)
+def load_summarizer():
+    global summarizer
+    if summarizer is None:
+        from transformers import pipeline
+        summarizer = pipeline(
+            "summarization",
+            model="facebook/bart-large-cnn",
+            device=-1
+        )
+    return summarizer
+
+
+# Generate summaries in batches of similar-length chunks (less padding per batch)
+# and return them in the original chunk order. Works for chunks of several papers.
+def summarize_chunks(chunks, batch_size=SUMMARY_BATCH_SIZE):
+    model = load_summarizer()
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+    summaries = [None] * len(chunks)
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        outputs = model(
+            [chunks[i] for i in batch],
+            batch_size=len(batch),
+            max_length=150,
+            min_length=60,
+            do_sample=False,
+            truncation=True
+        )
+        for i, out in zip(batch, outputs):
+            summaries[i] = out["summary_text"]
+        print(f"✅ Chunks {start + 1}-{start + len(batch)} of {len(chunks)} summarized")
+
+    return summaries
+
 
 # Split the final summary into structured academic sections
 def split_structured(summary):
@@ -114,9 +145,9 @@ def split_structured(summary):
         "Conclusion": ". ".join(sentences[5*n//6:])
     }
 
-section_summaries = split_structured(raw_summary)
 
-final_output = f"""
+def write_txt(txt_output_path, title, authors, date, section_summaries):
+    final_output = f"""
 Title:
 {title}
 
@@ -145,10 +176,29 @@ Conclusion:
 {section_summaries['Conclusion']}
 """
 
-with open(txt_output_path, "w", encoding="utf-8") as f:
-    f.write(final_output)
+    with open(txt_output_path, "w", encoding="utf-8") as f:
+        f.write(final_output)
+
+    print(f"✅ TXT summary saved as: {txt_output_path}")
+
+
+def write_json(json_output_path, title, authors, date, raw_summary, section_summaries):
+    with open(json_output_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "title": title,
+                "authors": authors,
+                "date": date,
+                "summary": raw_summary,
+                "sections": section_summaries,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2
+        )
+
+    print(f"✅ JSON summary saved as: {json_output_path}")
 
-print(f"✅ TXT summary saved as: {txt_output_path}")
 
 """**HTML**"""
 
@@ -160,9 +210,10 @@ def generate_html_from_summary(
     title,
     authors,
     date,
-    section_summaries
+    section_summaries,
+    output_dir=None
 ):
-    output_html_path = xml_path.with_suffix(".html")
+    output_html_path = Path(output_dir or xml_path.parent) / (xml_path.stem + ".html")
 
     authors_display = ", ".join(authors[:5])
     if len(authors) > 5:
@@ -226,10 +277,147 @@ def generate_html_from_summary(
 
     print(f"✅ HTML summary saved as: {output_html_path}")
 
-generate_html_from_summary(
-    xml_path=xml_path,
-    title=title,
-    authors=authors,
-    date=date,
-    section_summaries=section_summaries
-)
\ No newline at end of file
+
+def write_outputs(paper, raw_summary, output_dir=None):
+    xml_path = paper["xml_path"]
+    out_dir = Path(output_dir or xml_path.parent)
+    section_summaries = split_structured(raw_summary)
+
+    write_txt(out_dir / (xml_path.stem + "_summary.txt"), paper["title"], paper["authors"], paper["date"], section_summaries)
+    write_json(out_dir / (xml_path.stem + ".json"), paper["title"], paper["authors"], paper["date"], raw_summary, section_summaries)
+    generate_html_from_summary(
+        xml_path=xml_path,
+        title=paper["title"],
+        authors=paper["authors"],
+        date=paper["date"],
+        section_summaries=section_summaries,
+        output_dir=out_dir
+    )
+
+
+# XML files from a directory, a manifest (one path per line, relative to the
+# manifest) or single XML paths, in order and without duplicates.
+def collect_xml_paths(inputs):
+    paths = []
+    for item in inputs:
+        item = Path(item)
+        if item.is_dir():
+            paths.extend(sorted(item.glob("*.xml")))
+        elif item.suffix.lower() == ".xml":
+            paths.append(item)
+        else:
+            with open(item, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        paths.append(item.parent / line)
+    return list(dict.fromkeys(paths))
+
+
+# Parsed papers in input order; at most `prefetch` files are parsed ahead
+# of the one being summarized.
+def iter_parsed(executor, xml_paths, prefetch):
+    pending = []
+    remaining = iter(xml_paths)
+
+    def submit_next():
+        path = next(remaining, None)
+        if path is not None:
+            pending.append((path, executor.submit(parse_paper, path)))
+
+    for _ in range(prefetch):
+        submit_next()
+    while pending:
+        path, future = pending.pop(0)
+        submit_next()
+        try:
+            yield future.result()
+        except Exception as e:
+            print(f"❌ Failed to parse {path}: {e}")
+
+
+def summarize_papers(papers, batch_size=SUMMARY_BATCH_SIZE, output_dir=None):
+    # One length-sorted pass over the chunks of all papers in this step.
+    chunks = [c for paper in papers for c in paper["chunks"]]
+    summaries = summarize_chunks(chunks, batch_size=batch_size)
+
+    start = 0
+    for paper in papers:
+        end = start + len(paper["chunks"])
+        write_outputs(paper, " ".join(summaries[start:end]), output_dir)
+        start = end
+
+
+# Summarize one step; if it fails, retry its papers one at a time so a single
+# bad paper (or output write) only costs itself. Returns how many succeeded.
+def summarize_step(papers, batch_size=SUMMARY_BATCH_SIZE, output_dir=None):
+    try:
+        summarize_papers(papers, batch_size, output_dir)
+        return len(papers)
+    except Exception as e:
+        if len(papers) == 1:
+            print(f"❌ Failed to summarize {papers[0]['xml_path']}: {e}")
+            return 0
+        print(f"❌ Step of {len(papers)} papers failed ({e}); retrying one at a time")
+
+    done = 0
+    for paper in papers:
+        try:
+            summarize_papers([paper], batch_size, output_dir)
+            done += 1
+        except Exception as e:
+            print(f"❌ Failed to summarize {paper['xml_path']}: {e}")
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize GROBID XML papers with BART-Large-CNN.")
+    parser.add_argument("inputs", nargs="+", help="XML files, directories of XML files, or manifest files listing XML paths")
+    parser.add_argument("--out-dir", help="where to write TXT/JSON/HTML (default: next to each XML file)")
+    parser.add_argument("--batch-size", type=int, default=SUMMARY_BATCH_SIZE, help="chunks per model forward pass")
+    parser.add_argument("--papers-per-step", type=int, default=PAPERS_PER_STEP, help="papers whose chunks are batched together")
+    parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help="XML parsing processes")
+    parser.add_argument("--skip-existing", action="store_true", help="skip papers whose HTML output already exists")
+    args = parser.parse_args()
+
+    xml_paths = collect_xml_paths(args.inputs)
+    if args.out_dir:
+        Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    if args.skip_existing:
+        xml_paths = [
+            p for p in xml_paths
+            if not (Path(args.out_dir or p.parent) / (p.stem + ".html")).exists()
+        ]
+    print(f"Papers to summarize: {len(xml_paths)}")
+    if not xml_paths:
+        return
+
+    load_summarizer()
+    started = time.perf_counter()
+    done = 0
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        step = []
+        parsed = iter_parsed(executor, xml_paths, prefetch=args.workers + args.papers_per_step)
+        for paper in parsed:
+            print(f"Title: {paper['title']} ({len(paper['chunks'])} chunks)")
+            if not paper["chunks"]:
+                print(f"❌ No text extracted from {paper['xml_path']}")
+                continue
+            step.append(paper)
+            if len(step) >= args.papers_per_step:
+                done += summarize_step(step, args.batch_size, args.out_dir)
+                step = []
+        if step:
+            done += summarize_step(step, args.batch_size, args.out_dir)
+
+    failed = len(xml_paths) - done
+    hours = (time.perf_counter() - started) / 3600
+    print(
+        f"\nDone: {done} papers summarized, {failed} failed, "
+        f"{hours * 60:.1f} min, {done / hours if hours else 0:.1f} papers/hour"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1497,7 +1497,12 @@ if (summaryPage) {
   if (discussBtn) {
     discussBtn.addEventListener("click", (e) => {
       e.preventDefault();
-      window.open(CHAT_URL, "_blank", "noopener");
+      // Catalog papers are opened on the chatbot page by id, no upload needed.
+      const paperId = selected?.paperId;
+      const url = paperId
+        ? `${CHAT_URL}${CHAT_URL.includes("?") ? "&" : "?"}paper_id=${encodeURIComponent(paperId)}`
+        : CHAT_URL;
+      window.open(url, "_blank", "noopener");
     });
   }
 
@@ -1687,6 +1692,9 @@ if (pdfIconBtn && pdfInput) {
   }
 
   let pdfUploaded = false;
+  let docId = null;
+  // Server-side conversation, so follow-up questions see earlier answers.
+  let sessionId = null;
 
   function addMessage(sender, text) {
     const div = document.createElement("div");
@@ -1698,6 +1706,26 @@ if (pdfIconBtn && pdfInput) {
   }
 
   
+  // Indexing runs in the background on the server; poll until it finishes.
+  async function waitForIndexJob(jobId) {
+    while (true) {
+      const res = await fetch(`${CHATBOT_BASE_URL}/jobs/${jobId}`);
+      if (!res.ok) {
+        throw new Error("Could not read indexing status");
+      }
+
+      const job = await res.json();
+      if (job.status === "done") return job;
+      if (job.status === "failed") {
+        throw new Error(job.error || "Indexing failed");
+      }
+
+      const stage = (job.stage || "indexing").replace(/_/g, " ");
+      statusEl.textContent = `Processing PDF: ${stage} (${Math.round(job.percent || 0)}%)...`;
+      await new Promise((resolve) => setTimeout(resolve, 1500));
+    }
+  }
+
   uploadForm.addEventListener("submit", async (e) => {
     e.preventDefault();
 
@@ -1724,17 +1752,65 @@ if (pdfIconBtn && pdfInput) {
 
       const data = await res.json();
       console.log("Upload response:", data);
+      docId = data.doc_id || null;
+      sessionId = null;
+
+      if (data.job_id) {
+        await waitForIndexJob(data.job_id);
+      }
+
       pdfUploaded = true;
       statusEl.textContent = "PDF uploaded. You can start asking questions.";
     } catch (err) {
       console.error(err);
       pdfUploaded = false;
+      docId = null;
       statusEl.textContent =
         "Error uploading PDF. Please try again later.";
     }
   });
 
 
+  // Opened from "Discuss with AI": load the paper's prebuilt index by id.
+  async function openStoredPaper(paperId) {
+    statusEl.textContent = "Opening paper...";
+
+    try {
+      const res = await fetch(
+        `${CHATBOT_BASE_URL}/papers/${encodeURIComponent(paperId)}/open`,
+        { method: "POST" }
+      );
+
+      if (!res.ok) {
+        throw new Error("Open failed");
+      }
+
+      const data = await res.json();
+      console.log("Open paper response:", data);
+      docId = data.doc_id || null;
+      sessionId = null;
+
+      if (data.status !== "ready" && data.job_id) {
+        await waitForIndexJob(data.job_id);
+      }
+
+      pdfUploaded = true;
+      statusEl.textContent = "Paper loaded. You can start asking questions.";
+    } catch (err) {
+      console.error(err);
+      pdfUploaded = false;
+      docId = null;
+      statusEl.textContent =
+        "Could not open this paper. Please upload the PDF instead.";
+    }
+  }
+
+  const paperIdParam = new URLSearchParams(window.location.search).get("paper_id");
+  if (paperIdParam) {
+    openStoredPaper(paperIdParam);
+  }
+
+
 questionForm.addEventListener("submit", async (e) => {
   e.preventDefault();
 
@@ -1749,61 +1825,65 @@ questionForm.addEventListener("submit", async (e) => {
   addMessage("user", question);
   questionInput.value = "";
   addMessage("bot", "Thinking...");
+  const botMsg = messagesBox.lastElementChild;
 
   try {
-    
-    const url = `${CHATBOT_BASE_URL}/ask`;
+    // Server-sent events: render tokens as soon as the model produces them.
+    const url = `${CHATBOT_BASE_URL}/ask/stream`;
 
     const res = await fetch(url, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
       },
-      body: JSON.stringify({ question }), 
+      body: JSON.stringify({ question, doc_id: docId, session_id: sessionId }),
     });
 
-    const rawText = await res.text();
-    console.log("Ask raw response:", res.status, rawText);
-
-   
-    const lastMsg = messagesBox.lastElementChild;
-    if (lastMsg && lastMsg.classList.contains("chat-msg-bot")) {
-      messagesBox.removeChild(lastMsg);
-    }
-
-    if (!res.ok) {
-      addMessage(
-        "bot",
-        "Error from server while answering your question. Please try again."
-      );
+    if (!res.ok || !res.body) {
+      console.log("Ask stream response:", res.status, await res.text());
+      botMsg.textContent =
+        "Error from server while answering your question. Please try again.";
       return;
     }
 
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
     let answer = "";
 
-    
-    try {
-      const parsed = JSON.parse(rawText);
-
-      if (typeof parsed === "string") {
-        answer = parsed;
-      } else if (parsed.answer) {
-        answer = parsed.answer;
-      } else if (parsed.response) {
-        answer = parsed.response;
-      } else if (parsed.result) {
-        answer = parsed.result;
-      } else if (parsed.msg) {
-        answer = parsed.msg;
-      } else {
-        answer = rawText || "No answer returned.";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split("\n\n");
+      buffer = events.pop();
+
+      for (const evt of events) {
+        const lines = evt.split("\n");
+        const name = (lines.find((l) => l.startsWith("event: ")) || "").slice(7);
+        const dataLine = lines.find((l) => l.startsWith("data: "));
+        if (!dataLine) continue;
+
+        const payload = JSON.parse(dataLine.slice(6));
+        if (name === "error") {
+          throw new Error(payload.error || "Stream error");
+        }
+        if (name === "done") {
+          sessionId = payload.session_id || sessionId;
+          continue;
+        }
+        if (payload.delta) {
+          answer += payload.delta;
+          botMsg.textContent = answer;
+          messagesBox.scrollTop = messagesBox.scrollHeight;
+        }
       }
-    } catch (jsonErr) {
-      
-      answer = rawText || "No answer returned.";
     }
 
-    addMessage("bot", answer);
+    if (!answer.trim()) {
+      botMsg.textContent = "No answer returned.";
+    }
   } catch (err) {
     console.error("Ask error:", err);
 